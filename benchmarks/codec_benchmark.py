@@ -0,0 +1,94 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+from spotdl.utils.ffmpeg import convert, get_ffmpeg_path
+
+
+def make_sample(ffmpeg, path, seconds):
+    # Stereo opus in a webm container, the stream YouTube Music serves for most tracks
+    command = [ffmpeg, "-nostdin", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}", "-ac", "2", "-c:a", "libopus", "-b:a", "128k", str(path)]
+    subprocess.run(command, check=True)
+
+
+def measure(runs, run_once):
+    # ffmpeg runs as a child process, so its CPU time shows up in RUSAGE_CHILDREN
+    wall_times, cpu_times, output_bytes = [], [], 0
+    for run in range(runs):
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        output_path = run_once(run)
+        wall_times.append(time.perf_counter() - start)
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_times.append((after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime))
+        output_bytes = output_path.stat().st_size
+    return {
+        "runs": runs,
+        "wall_mean_ms": round(statistics.mean(wall_times) * 1000, 2),
+        "cpu_mean_ms": round(statistics.mean(cpu_times) * 1000, 2),
+        "output_kb": round(output_bytes / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare spotdl's mp3 transcode with passthrough on a local audio file")
+    parser.add_argument("--sample", help="webm, opus or m4a file as downloaded by yt-dlp, a generated tone is used when missing")
+    parser.add_argument("--seconds", type=int, default=210, help="Length of the generated sample")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--format", default="mp3", help="Format the transcode path converts to")
+    parser.add_argument("--bitrate", default="128k", help="Bitrate the transcode path uses, spotdl's auto picks the source bitrate")
+    args = parser.parse_args()
+
+    ffmpeg = shutil.which("ffmpeg") or (str(get_ffmpeg_path()) if get_ffmpeg_path() else None)
+    if not ffmpeg:
+        print(json.dumps({"error": "ffmpeg not found"}))
+        return 1
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        sample = Path(args.sample) if args.sample else temp_dir / "sample.webm"
+        if not args.sample:
+            make_sample(ffmpeg, sample, args.seconds)
+
+        # spotdl's own passthrough: same extension is a file move, webm to opus is a stream copy
+        source_format = sample.suffix.lstrip(".")
+        passthrough_format = "m4a" if source_format == "m4a" else "opus"
+
+        def transcode(run):
+            output_path = temp_dir / f"transcode-{run}.{args.format}"
+            success, error = convert(sample, output_path, ffmpeg=ffmpeg, output_format=args.format, bitrate=args.bitrate)
+            if not success:
+                raise RuntimeError(error)
+            return output_path
+
+        def passthrough(run):
+            output_path = temp_dir / f"passthrough-{run}.{passthrough_format}"
+            if source_format == passthrough_format:
+                shutil.copyfile(sample, output_path)
+                return output_path
+            success, error = convert(sample, output_path, ffmpeg=ffmpeg, output_format=passthrough_format, bitrate=None)
+            if not success:
+                raise RuntimeError(error)
+            return output_path
+
+        report = {
+            "sample": {"path": str(sample) if args.sample else "generated", "format": source_format, "kb": round(sample.stat().st_size / 1024, 1)},
+            "transcode": measure(args.runs, transcode),
+            "passthrough": measure(args.runs, passthrough),
+        }
+
+    report["cpu_saved_pct"] = round(100 * (1 - report["passthrough"]["cpu_mean_ms"] / max(report["transcode"]["cpu_mean_ms"], 0.001)), 1)
+    report["wall_speedup"] = round(report["transcode"]["wall_mean_ms"] / max(report["passthrough"]["wall_mean_ms"], 0.001), 1)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
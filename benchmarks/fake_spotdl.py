@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+
+# Stand-in for the spotdl CLI. Behaviour is set through environment variables so the
+# benchmark can put it on PATH as "spotdl" without changing how SpotSpot calls it.
+DURATION = float(os.getenv("FAKE_SPOTDL_DURATION", "0.05"))
+OUTPUT_LINES = int(os.getenv("FAKE_SPOTDL_OUTPUT_LINES", "20"))
+FAILURE_RATE = float(os.getenv("FAKE_SPOTDL_FAILURE_RATE", "0"))
+ALBUM_TRACKS = int(os.getenv("FAKE_SPOTDL_ALBUM_TRACKS", "10"))
+
+
+def main():
+    if sys.argv[1:] == ["--version"]:
+        print("4.5.2")
+        return 0
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output")
+    parser.add_argument("--m3u")
+    parser.add_argument("--archive")
+    args, urls = parser.parse_known_args()
+    urls = [url for url in urls if url.startswith("https://")]
+
+    # Collections expand into several songs, like spotdl does after fetching them from Spotify
+    songs = []
+    for url in urls:
+        if "/track/" in url:
+            songs.append(url.split("?")[0])
+        else:
+            songs += [f"https://open.spotify.com/track/{zlib.crc32(f'{url}#{index}'.encode()):022d}" for index in range(ALBUM_TRACKS)]
+    print(f"Found {len(songs)} songs in {len(urls)} queries (Track)", flush=True)
+
+    archived = set()
+    if args.archive and os.path.exists(args.archive):
+        with open(args.archive, encoding="utf-8") as archive_file:
+            archived = {line.strip() for line in archive_file if line.strip()}
+
+    output_dir = os.path.dirname(args.output or "") or "."
+    finished, written = [], []
+    for index, song in enumerate(songs):
+        if song in archived:
+            print(f"Skipping {song} (skip file found)", flush=True)
+            continue
+        time.sleep(DURATION / max(len(songs), 1))
+        # spotdl logs a lot on stderr at the default DEBUG level
+        for line in range(OUTPUT_LINES):
+            print(f"DEBUG:spotdl:[{index}] matching {song} candidate {line}", file=sys.stderr)
+        if random.random() < FAILURE_RATE:
+            print(f"AudioProviderError: YT-DLP download error - {song}", file=sys.stderr, flush=True)
+            continue
+        path = os.path.join(output_dir, f"{song.rsplit('/', 1)[-1]}.mp3")
+        written.append(path)
+        finished.append(song)
+        print(f'Downloaded "{song}": https://music.youtube.com/watch?v={index}', flush=True)
+
+    if args.m3u:
+        with open(args.m3u, "w", encoding="utf-8") as m3u_file:
+            m3u_file.write("".join(f"{path}\n" for path in written))
+    if args.archive:
+        with open(args.archive, "a", encoding="utf-8") as archive_file:
+            archive_file.write("".join(f"{song}\n" for song in finished))
+
+    return 1 if len(finished) + len(archived & set(songs)) < len(songs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
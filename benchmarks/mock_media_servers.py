@@ -0,0 +1,87 @@
+import time
+import threading
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PLEX_IDENTITY = '<MediaContainer size="0" machineIdentifier="mock-plex" version="1.40.0" friendlyName="Mock Plex" platform="Linux"></MediaContainer>'
+PLEX_LIBRARY = '<MediaContainer size="1" identifier="com.plexapp.plugins.library" title1="Plex Library"><Directory key="sections" title="Library Sections" /></MediaContainer>'
+PLEX_SECTIONS = (
+    '<MediaContainer size="1">'
+    '<Directory key="1" type="artist" title="Music" agent="tv.plex.agents.music" scanner="Plex Music" language="en-US" uuid="mock-section" refreshing="0" updatedAt="0" createdAt="0" scannedAt="0">'
+    '<Location id="1" path="/data/media/music" />'
+    "</Directory></MediaContainer>"
+)
+
+
+class MockMediaServer:
+    # Answers the Plex and Jellyfin calls PlaylistManager makes, after a fixed delay
+    def __init__(self, kind, delay=0.05, port=0):
+        self.kind = kind
+        self.delay = delay
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self, status, body=b"", content_type="text/xml"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if length:
+                    self.rfile.read(length)
+                path = urlparse(self.path).path
+                with server.lock:
+                    server.requests.append((self.command, path))
+                time.sleep(server.delay)
+
+                if server.kind == "jellyfin":
+                    if path in ("/Library/Refresh", "/Library/Media/Updated"):
+                        return self.respond(204)
+                    return self.respond(404)
+
+                if path == "/":
+                    return self.respond(200, PLEX_IDENTITY.encode())
+                if path == "/library":
+                    return self.respond(200, PLEX_LIBRARY.encode())
+                if path == "/library/sections":
+                    return self.respond(200, PLEX_SECTIONS.encode())
+                if path.startswith("/library/sections/") and path.endswith("/refresh"):
+                    return self.respond(200)
+                if path == "/playlists/upload":
+                    return self.respond(200)
+                return self.respond(404)
+
+            do_GET = handle_request
+            do_POST = handle_request
+            do_PUT = handle_request
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,111 @@
+import json
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_search_items(search_type, query, limit):
+    items = []
+    for index in range(limit):
+        image = {"url": f"https://i.scdn.co/image/{search_type}-{index}", "height": 640, "width": 640}
+        item = {
+            "id": f"{search_type}{index:018d}",
+            "name": f"{query} {search_type} {index}",
+            "external_urls": {"spotify": f"https://open.spotify.com/{search_type}/{search_type}{index:018d}"},
+            "images": [image],
+        }
+        if search_type == "track":
+            item["artists"] = [{"name": f"{query} artist"}]
+            item["album"] = {"name": f"{query} album", "images": [image]}
+            item["external_ids"] = {"isrc": f"MOCK{index:08d}"}
+            del item["images"]
+        elif search_type == "album":
+            item["artists"] = [{"name": f"{query} artist"}]
+            item["release_date"] = "2024-01-01"
+        elif search_type == "artist":
+            item["followers"] = {"total": index * 1000}
+        elif search_type == "playlist":
+            item["owner"] = {"display_name": "Spotify"}
+        items.append(item)
+    return items
+
+
+class MockSpotifyServer:
+    def __init__(self, connect_delay=0.05, token_delay=0.1, api_delay=0.02, port=0):
+        self.connect_delay = connect_delay
+        self.token_delay = token_delay
+        self.api_delay = api_delay
+        self.connections = 0
+        self.token_requests = 0
+        self.search_requests = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                # Stand-in for TCP + TLS handshake cost of a fresh connection
+                with server.lock:
+                    server.connections += 1
+                time.sleep(server.connect_delay)
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, payload, status=200):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.rfile.read(length)
+                if urlparse(self.path).path != "/api/token":
+                    return self.send_json({"error": "not found"}, 404)
+                with server.lock:
+                    server.token_requests += 1
+                time.sleep(server.token_delay)
+                self.send_json({"access_token": "mock-token", "token_type": "Bearer", "expires_in": 3600})
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if parsed.path != "/v1/search":
+                    return self.send_json({"error": "not found"}, 404)
+                with server.lock:
+                    server.search_requests += 1
+                params = parse_qs(parsed.query)
+                query = params.get("q", [""])[0]
+                limit = int(params.get("limit", ["10"])[0])
+                time.sleep(server.api_delay)
+                results = {}
+                for search_type in params.get("type", ["track"])[0].split(","):
+                    results[f"{search_type}s"] = {"items": make_search_items(search_type, query, limit), "total": limit}
+                self.send_json(results)
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
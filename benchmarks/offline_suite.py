@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "spotspot"))
+
+from flask import Flask
+from flask_socketio import SocketIO
+from socketio.packet import Packet, EVENT
+from services.config_service import ConfigService
+from services.history_store import HistoryStore, ACTIVE_STATUSES
+from services.download_queue import PersistentQueue
+from services.download_service import DownloadService
+from services.library_index import LibraryIndex
+from services.playlist_manager import PlaylistManager
+from services.spotfiy_service import SpotifyService
+from services.metrics import MeteredPacket
+from mock_spotify import MockSpotifyServer
+from mock_media_servers import MockMediaServer
+
+SECTIONS = ("process_downloads", "status_emit", "m3u", "search", "media_servers", "socket_clients")
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p95_ms": round(latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def encoded_size(event, data):
+    encoded_packet = Packet(EVENT, data=[event, data]).encode()
+    return sum(len(part) for part in encoded_packet) if isinstance(encoded_packet, list) else len(encoded_packet)
+
+
+def setup_environment(temp_dir, args):
+    # Everything SpotSpot reads or writes stays inside the temporary folder
+    bin_dir = os.path.join(temp_dir, "bin")
+    os.makedirs(bin_dir)
+    spotdl_path = os.path.join(bin_dir, "spotdl")
+    with open(spotdl_path, "w", encoding="utf-8") as spotdl_file:
+        spotdl_file.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCHMARK_DIR, "fake_spotdl.py")}" "$@"\n')
+    os.chmod(spotdl_path, 0o755)
+
+    music_dir = os.path.join(temp_dir, "music")
+    os.environ.update(
+        {
+            "PATH": f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+            "FAKE_SPOTDL_DURATION": str(args.spotdl_duration),
+            "FAKE_SPOTDL_OUTPUT_LINES": str(args.spotdl_output_lines),
+            "FAKE_SPOTDL_FAILURE_RATE": str(args.spotdl_failure_rate),
+            "TRACK_OUTPUT": os.path.join(music_dir, "singles", "{artist} - {title}.{output-ext}"),
+            "ALBUM_OUTPUT": os.path.join(music_dir, "{artist}", "{album}", "{title}.{output-ext}"),
+            "PLAYLIST_OUTPUT": os.path.join(music_dir, "{list-name}", "{title}.{output-ext}"),
+            "ARTIST_OUTPUT": os.path.join(music_dir, "{artist}", "{album}", "{title}.{output-ext}"),
+            "HISTORY_DB_PATH": os.path.join(temp_dir, "spotspot.db"),
+            "M3U_INDEX_PATH": os.path.join(temp_dir, "m3u_index.json"),
+            "M3U_PLAYLIST_PATH": os.path.join(temp_dir, "playlists"),
+            "ABSOLUTE_SERVER_PATH": os.path.join(music_dir, "singles"),
+            "TRIGGER_PLEX_SCAN": "False",
+            "TRIGGER_JELLYFIN_SCAN": "False",
+            "GENERATE_M3U_PLAYLIST": "False",
+            "LIBRARY_INDEX": "False",
+            "LIBRARY_SCAN": "False",
+            "RETRY_MAX_ATTEMPTS": "0",
+            "HISTORY_MAX_ROWS": str(max(args.history_rows, args.jobs) * 2),
+        }
+    )
+
+
+def make_config(temp_dir, name, **overrides):
+    config = ConfigService()
+    config.history_db_path = os.path.join(temp_dir, f"{name}.db")
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    return config
+
+
+def make_download_service(config):
+    socketio = SocketIO(Flask(__name__), serializer=MeteredPacket)
+    return DownloadService(config, PlaylistManager(config), socketio, PersistentQueue(config), HistoryStore(config), None, LibraryIndex(config))
+
+
+def bench_process_downloads(temp_dir, args):
+    report = {}
+    for batch_downloads in ("False", "True"):
+        config = make_config(temp_dir, f"downloads_batch_{batch_downloads.lower()}", batch_downloads=batch_downloads, batch_window=0.2, download_workers=args.workers)
+        download_service = make_download_service(config)
+
+        enqueue_latencies = []
+        for index in range(args.jobs):
+            request = {"url": f"https://open.spotify.com/track/{index:022d}", "type": "track", "name": f"Track {index}", "artist": "Benchmark"}
+            enqueue_latencies.append(timed(download_service.add_item_to_queue, request))
+
+        start = time.perf_counter()
+        for worker_id in range(config.download_workers):
+            threading.Thread(target=download_service.process_downloads, args=(worker_id,), daemon=True).start()
+        while True:
+            status_counts = download_service.history_store.get_status_counts()
+            if not any(status_counts.get(status) for status in ACTIVE_STATUSES):
+                break
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        report[f"batch_{batch_downloads.lower()}"] = {
+            "jobs": args.jobs,
+            "workers": config.download_workers,
+            "elapsed_s": round(elapsed, 3),
+            "jobs_per_s": round(args.jobs / elapsed, 2),
+            "enqueue": summarize(enqueue_latencies),
+            "statuses": status_counts,
+        }
+    return report
+
+
+def bench_status_emit(temp_dir, args):
+    config = make_config(temp_dir, "status_emit")
+    download_service = make_download_service(config)
+    history_store = download_service.history_store
+
+    start = time.perf_counter()
+    for index in range(args.history_rows):
+        history_store.add({"url": f"https://open.spotify.com/track/{index:022d}", "name": f"Track {index}", "type": "track", "artist": "Benchmark", "status": "Complete"})
+    fill_s = time.perf_counter() - start
+
+    report = {"history_rows": args.history_rows, "fill_s": round(fill_s, 3)}
+    # A client gets one page, the whole history is what every client used to receive
+    for name, page_size in (("page_snapshot", 50), ("full_snapshot", args.history_rows)):
+        latencies, size = [], 0
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            snapshot = download_service.get_status_snapshot(1, page_size)
+            size = encoded_size("update_status", snapshot)
+            latencies.append(time.perf_counter() - start)
+        report[name] = dict(summarize(latencies), bytes=size)
+
+    items = [dict(item, status="Downloading...") for item in history_store.get_page(1, 100)["history"]]
+    latencies, size = [], 0
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        patch = {"base_version": 0, "version": 1, "items": items}
+        size = encoded_size("status_patch", patch)
+        latencies.append(time.perf_counter() - start)
+    report["patch_100_items"] = dict(summarize(latencies), bytes=size)
+    return report
+
+
+def bench_m3u(temp_dir, args):
+    config = make_config(temp_dir, "m3u", generate_m3u_playlist="True")
+    os.makedirs(config.absolute_server_path, exist_ok=True)
+    start = time.perf_counter()
+    for index in range(args.m3u_files):
+        open(os.path.join(config.absolute_server_path, f"Benchmark - Track {index:06d}.mp3"), "w").close()
+    create_s = time.perf_counter() - start
+
+    playlist_manager = PlaylistManager(config)
+    report = {"files": args.m3u_files, "create_files_s": round(create_s, 3)}
+    report["cold_ms"] = round(timed(playlist_manager.generate_m3u_playlist) * 1000, 2)
+    report["unchanged_ms"] = round(timed(playlist_manager.generate_m3u_playlist) * 1000, 2)
+    open(os.path.join(config.absolute_server_path, "Benchmark - New Track.mp3"), "w").close()
+    report["one_new_file_ms"] = round(timed(playlist_manager.generate_m3u_playlist) * 1000, 2)
+
+    m3u_file_path = os.path.join(config.m3u_playlist_path, f"{config.m3u_playlist_name}.m3u")
+    report["playlist_bytes"] = os.path.getsize(m3u_file_path)
+    return report
+
+
+def bench_search(temp_dir, args):
+    config = make_config(temp_dir, "search", spotify_pool_size=args.concurrency)
+    server = MockSpotifyServer(connect_delay=0.01, token_delay=0.02, api_delay=args.api_delay).start()
+    try:
+        spotify_service = SpotifyService(config)
+        sp = spotify_service.get_spotify_client()
+        sp.prefix = f"{server.base_url}/v1/"
+        sp.auth_manager.OAUTH_TOKEN_URL = f"{server.base_url}/api/token"
+
+        report = {"mock_api_delay_ms": args.api_delay * 1000, "concurrency": args.concurrency}
+        for search_type in ("track", "all"):
+            for name, queries in (("miss", [f"{search_type} query {index}" for index in range(args.searches)]), ("hit", [f"{search_type} query {index % 10}" for index in range(args.searches)])):
+                latencies = []
+
+                def search(query):
+                    latencies.append(timed(spotify_service.perform_spotify_search, {"query": query, "type": search_type}))
+
+                with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                    list(executor.map(search, queries))
+                report[f"{search_type}_{name}"] = summarize(latencies)
+        report["api_requests"] = server.search_requests
+    finally:
+        server.stop()
+    return report
+
+
+def bench_media_servers(temp_dir, args):
+    plex_server = MockMediaServer("plex", delay=args.media_server_delay).start()
+    jellyfin_server = MockMediaServer("jellyfin", delay=args.media_server_delay).start()
+    try:
+        config = make_config(temp_dir, "media_servers", plex_address=plex_server.base_url, plex_token="mock-token", jellyfin_address=jellyfin_server.base_url, jellyfin_api_key="mock-key")
+        playlist_manager = PlaylistManager(config)
+        scan_paths = [os.path.join(config.absolute_server_path, f"folder {index}") for index in range(5)]
+
+        report = {"mock_delay_ms": args.media_server_delay * 1000}
+        report["plex_first_refresh_ms"] = round(timed(playlist_manager.refresh_plex_library) * 1000, 2)
+        for name, call in (
+            ("plex_refresh", lambda: playlist_manager.refresh_plex_library()),
+            ("plex_partial_scan_5", lambda: playlist_manager.refresh_plex_library(scan_paths)),
+            ("plex_playlist_import", playlist_manager.import_playlist_to_plex),
+            ("jellyfin_refresh", lambda: playlist_manager.refresh_jellyfin_library()),
+            ("jellyfin_partial_scan_5", lambda: playlist_manager.refresh_jellyfin_library(scan_paths)),
+        ):
+            report[name] = summarize([timed(call) for _ in range(args.iterations)])
+        report["plex_requests"] = len(plex_server.requests)
+        report["jellyfin_requests"] = len(jellyfin_server.requests)
+    finally:
+        plex_server.stop()
+        jellyfin_server.stop()
+    return report
+
+
+def bench_socket_clients(temp_dir, args):
+    # The real app with its Socket.IO handlers, driven by in-process test clients
+    history_store = HistoryStore(make_config(temp_dir, "socket_clients"))
+    for index in range(args.history_rows):
+        history_store.add({"url": f"https://open.spotify.com/track/{index:022d}", "name": f"Track {index}", "type": "track", "artist": "Benchmark", "status": "Complete"})
+    os.environ["HISTORY_DB_PATH"] = history_store.config.history_db_path
+    import spotspot
+
+    web_app = spotspot.spotspot_web_app
+    start = time.perf_counter()
+    clients = [web_app.socketio.test_client(web_app.app) for _ in range(args.clients)]
+    connect_s = time.perf_counter() - start
+
+    latencies = []
+
+    def request_status(client):
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            client.emit("get_status", {"page": 1, "page_size": 50})
+            latencies.append(time.perf_counter() - start)
+            client.get_received()
+
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(request_status, clients))
+
+    # One status change fanned out to every connected client
+    status_broadcaster = web_app.download_services.status_broadcaster
+    broadcast_latencies = []
+    for index in range(args.iterations):
+        status_broadcaster.item_changed({"id": index + 1, "name": f"Track {index}", "type": "track", "artist": "Benchmark", "url": "", "status": "Downloading..."})
+        broadcast_latencies.append(timed(status_broadcaster.flush))
+    received = sum(1 for client in clients for packet in client.get_received() if packet["name"] == "status_patch")
+
+    for client in clients:
+        client.disconnect()
+    return {
+        "clients": args.clients,
+        "history_rows": args.history_rows,
+        "connect_ms_per_client": round(connect_s * 1000 / args.clients, 3),
+        "concurrent_get_status": summarize(latencies),
+        "broadcast_patch": summarize(broadcast_latencies),
+        "patches_received": received,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline SpotSpot benchmarks against a fake spotdl and local Spotify, Plex and Jellyfin stand-ins")
+    parser.add_argument("--only", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--spotdl-duration", type=float, default=0.05, help="Seconds the fake spotdl spends per run")
+    parser.add_argument("--spotdl-output-lines", type=int, default=20, help="stderr lines the fake spotdl writes per song")
+    parser.add_argument("--spotdl-failure-rate", type=float, default=0.0)
+    parser.add_argument("--history-rows", type=int, default=10000)
+    parser.add_argument("--m3u-files", type=int, default=100000)
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--api-delay", type=float, default=0.02)
+    parser.add_argument("--media-server-delay", type=float, default=0.02)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    # SpotSpot logs every job at INFO, which would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        setup_environment(temp_dir, args)
+        for section in SECTIONS:
+            if section in args.only:
+                start = time.perf_counter()
+                report[section] = globals()[f"bench_{section}"](temp_dir, args)
+                report[section]["section_s"] = round(time.perf_counter() - start, 3)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
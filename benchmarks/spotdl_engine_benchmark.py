@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spotspot"))
+
+from services.spotdl_engine import SpotdlEngineWorker
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "jobs": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+    }
+
+
+def measure_subprocess(jobs):
+    # Every job pays for a fresh interpreter and spotdl's imports, as DOWNLOAD_ENGINE=subprocess does
+    latencies = []
+    for _ in range(jobs):
+        start = time.perf_counter()
+        subprocess.run(["spotdl", "--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def measure_engine(config, jobs, output):
+    engine_worker = SpotdlEngineWorker(config, "benchmark")
+    start = time.perf_counter()
+    engine_worker.start()
+    startup = time.perf_counter() - start
+
+    latencies = []
+    try:
+        for _ in range(jobs):
+            start = time.perf_counter()
+            engine_worker.run_job([], output)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        engine_worker.stop()
+
+    result = summarize(latencies)
+    result.update(startup_ms=round(startup * 1000, 2), rss_mb=round(engine_worker.rss_mb, 1))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-job spotdl subprocess start-up with a warm spotdl engine on empty jobs")
+    parser.add_argument("--jobs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config_path = os.path.join(temp_dir, "config.json")
+        with open(config_path, "w", encoding="utf-8") as config_file:
+            json.dump({"client_id": "benchmark-id", "client_secret": "benchmark-secret", "no_cache": True, "headless": True}, config_file)
+
+        config = SimpleNamespace(config_path=config_path, engine_max_jobs=0, engine_max_memory_mb=0)
+        output = os.path.join(temp_dir, "{artist} - {title}.{output-ext}")
+
+        report = {
+            "subprocess": measure_subprocess(args.jobs),
+            "warm_engine": measure_engine(config, args.jobs, output),
+        }
+    report["speedup_per_job"] = round(report["subprocess"]["mean_ms"] / max(report["warm_engine"]["mean_ms"], 0.001), 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spotspot"))
+
+import spotipy
+from spotipy.oauth2 import SpotifyClientCredentials
+from services.spotfiy_service import SpotifyService
+from mock_spotify import MockSpotifyServer
+
+
+def per_call_search(server, config, query):
+    # Mirrors the previous behaviour: new credentials manager and client for every search
+    client_credentials_manager = SpotifyClientCredentials(client_id=config.client_id, client_secret=config.client_secret)
+    client_credentials_manager.OAUTH_TOKEN_URL = f"{server.base_url}/api/token"
+    sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+    sp.prefix = f"{server.base_url}/v1/"
+    return sp.search(q=query, limit=config.search_limit, type="track")
+
+
+def shared_client_search(service, config, query):
+    return service.get_spotify_client().search(q=query, limit=config.search_limit, type="track")
+
+
+def measure(search, requests, concurrency):
+    latencies = []
+
+    def timed(index):
+        start = time.perf_counter()
+        search(f"query {index}")
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "total_s": round(elapsed, 4),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-call Spotify clients with the shared SpotifyService client against a local mock API")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--connect-delay", type=float, default=0.05)
+    parser.add_argument("--token-delay", type=float, default=0.1)
+    parser.add_argument("--api-delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    config = SimpleNamespace(client_id="mock-id", client_secret="mock-secret", search_limit=10, search_cache_size=0, search_cache_ttl=0, spotify_pool_size=args.concurrency)
+    server = MockSpotifyServer(connect_delay=args.connect_delay, token_delay=args.token_delay, api_delay=args.api_delay).start()
+
+    report = {"mock": {"connect_delay_s": args.connect_delay, "token_delay_s": args.token_delay, "api_delay_s": args.api_delay}}
+    try:
+        for concurrency in sorted({1, args.concurrency}):
+            server.connections = server.token_requests = 0
+            result = measure(lambda query: per_call_search(server, config, query), args.requests, concurrency)
+            result.update(connections=server.connections, token_requests=server.token_requests)
+            report[f"per_call_c{concurrency}"] = result
+
+            service = SpotifyService(config)
+            sp = service.get_spotify_client()
+            sp.prefix = f"{server.base_url}/v1/"
+            sp.auth_manager.OAUTH_TOKEN_URL = f"{server.base_url}/api/token"
+            server.connections = server.token_requests = 0
+            result = measure(lambda query: shared_client_search(service, config, query), args.requests, concurrency)
+            result.update(connections=server.connections, token_requests=server.token_requests)
+            report[f"shared_c{concurrency}"] = result
+    finally:
+        server.stop()
+
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
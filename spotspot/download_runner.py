@@ -0,0 +1,53 @@
+import time
+import logging
+import threading
+from flask import Flask
+from flask_socketio import SocketIO
+from prometheus_client import REGISTRY, start_http_server
+from services.config_service import ConfigService
+from services.spotfiy_service import SpotifyService
+from services.download_service import DownloadService
+from services.playlist_manager import PlaylistManager
+from services.history_store import HistoryStore
+from services.download_queue import PersistentQueue
+from services.library_index import LibraryIndex
+from services.process_commands import CommandChannel
+from services.metrics import QueueCollector
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class DownloadRunner:
+    # Runs the download workers in their own process, the web workers only queue jobs in the shared database
+    def __init__(self):
+        self.config = ConfigService()
+        # The runner is not monkey-patched, so delayed flushes from the worker threads need real threads, not greenlets
+        if self.config.socketio_message_queue:
+            # Write only, status events are handed to the web workers through the message queue
+            self.socketio = SocketIO(message_queue=self.config.socketio_message_queue, async_mode="threading")
+        else:
+            self.socketio = SocketIO(Flask(__name__), async_mode="threading")
+        self.history_store = HistoryStore(self.config)
+        self.download_queue = PersistentQueue(self.config)
+        self.library_index = LibraryIndex(self.config)
+        self.spotify_services = SpotifyService(self.config)
+        self.playlist_manager = PlaylistManager(self.config)
+        self.download_services = DownloadService(self.config, self.playlist_manager, self.socketio, self.download_queue, self.history_store, self.spotify_services, self.library_index)
+        self.commands = CommandChannel(self.config, {"cancel_active": self.download_services.cancel_active_download, "reload_settings": self.config.load_saved_settings})
+
+    def run(self):
+        if self.config.runner_metrics_port:
+            # Job and worker metrics are recorded here, not in the web workers
+            REGISTRY.register(QueueCollector(self.download_services))
+            start_http_server(self.config.runner_metrics_port)
+            logging.info(f"Runner metrics served on port {self.config.runner_metrics_port}")
+        self.commands.start()
+        for worker_id in range(self.config.download_workers):
+            download_thread = threading.Thread(target=self.download_services.process_downloads, args=(worker_id,), daemon=True)
+            download_thread.start()
+        while True:
+            time.sleep(60)
+
+
+if __name__ == "__main__":
+    DownloadRunner().run()
@@ -1,15 +1,127 @@
 import os
+import re
+import hmac
 import json
 import logging
 import platform
+import threading
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+SPOTDL_FORMATS = ("mp3", "flac", "ogg", "opus", "m4a", "wav")
+SPOTDL_BITRATES = ("auto", "disable", "8k", "16k", "24k", "32k", "40k", "48k", "64k", "80k", "96k", "112k", "128k", "160k", "192k", "224k", "256k", "320k") + tuple(str(quality) for quality in range(10))
+AUDIO_PROVIDERS = ("youtube", "youtube-music", "soundcloud", "bandcamp", "piped")
+LYRICS_PROVIDERS = ("genius", "musixmatch", "azlyrics", "synced")
+ITEM_TYPES = ("track", "album", "playlist", "artist")
+# Formats YouTube streams come in, kept without re-encoding in passthrough mode
+PASSTHROUGH_FORMATS = ("opus", "m4a")
+PASSTHROUGH_PROFILE = "passthrough"
+PROFILE_NAME = re.compile(r"^[A-Za-z0-9_-]{1,40}$")
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() not in ("true", "false"):
+        raise ValueError("expected True or False")
+    return str(value).lower() == "true"
+
+
+def parse_flag(value):
+    # SpotSpot's own switches are kept as "True"/"False" strings like the environment variables
+    return "True" if parse_bool(value) else "False"
+
+
+def parse_count(minimum, maximum=None):
+    def parse(value):
+        count = int(value)
+        if count < minimum or (maximum is not None and count > maximum):
+            raise ValueError(f"must be between {minimum} and {maximum}" if maximum is not None else f"must be at least {minimum}")
+        return count
+
+    return parse
+
+
+def parse_seconds(value):
+    seconds = float(value)
+    if seconds < 0:
+        raise ValueError("must not be negative")
+    return seconds
+
+
+def parse_choice(options):
+    def parse(value):
+        if str(value) not in options:
+            raise ValueError(f"expected one of {', '.join(options)}")
+        return str(value)
+
+    return parse
+
+
+def parse_providers(options, allow_empty=False):
+    def parse(value):
+        providers = [provider.strip() for provider in (value.split(",") if isinstance(value, str) else value) if provider.strip()]
+        if (not providers and not allow_empty) or any(provider not in options for provider in providers):
+            raise ValueError(f"expected a list of {', '.join(options)}")
+        return providers
+
+    return parse
+
+
+def parse_text(value):
+    return str(value) if value not in (None, "") else None
+
+
+# spotdl settings a download profile can override, applied per job
+PROFILE_SETTINGS = {
+    "format": parse_choice(SPOTDL_FORMATS),
+    "bitrate": parse_choice(SPOTDL_BITRATES),
+    "threads": parse_count(1, 64),
+    "audio_providers": parse_providers(AUDIO_PROVIDERS),
+    "lyrics_providers": parse_providers(LYRICS_PROVIDERS),
+    "max_retries": parse_count(0),
+    "sponsor_block": parse_bool,
+    "generate_lrc": parse_bool,
+    "skip_album_art": parse_bool,
+    "only_verified_results": parse_bool,
+    "filter_results": parse_bool,
+    "ffmpeg_args": parse_text,
+    "yt_dlp_args": parse_text,
+}
+
+# spotdl's command line can only turn these on, or turn filtering off, so a profile cannot undo config.json
+PROFILE_SWITCH_VALUES = {"sponsor_block": True, "generate_lrc": True, "skip_album_art": True, "only_verified_results": True, "filter_results": False}
+
+# Everything that can be changed without a restart, worker counts and paths still need one
+RELOADABLE_SETTINGS = {
+    **PROFILE_SETTINGS,
+    "search_limit": parse_count(1, 50),
+    "batch_window": parse_seconds,
+    "batch_max_size": parse_count(1),
+    "retry_max_attempts": parse_count(0),
+    "retry_base_delay": parse_seconds,
+    "retry_max_delay": parse_seconds,
+    "throttle_pause": parse_seconds,
+    "extra_logging": parse_flag,
+    "passthrough_types": parse_providers(ITEM_TYPES, allow_empty=True),
+    "passthrough_format": parse_choice(PASSTHROUGH_FORMATS),
+    "queue_priority_order": parse_providers(ITEM_TYPES),
+    "queue_aging": parse_seconds,
+    "queue_fair_share": parse_flag,
+}
+
 
 class ConfigService:
     def __init__(self):
+        self.settings_lock = threading.Lock()
+        # Bumped on every reload so warm spotdl engines know to restart with the new config
+        self.settings_version = 0
+        self.setting_overrides = {}
+        self.profile_overrides = {}
         self.get_vars()
         self.get_spotdl_vars()
+        self.load_profiles()
+        self.load_saved_settings()
         self.create_config_file()
 
     def get_vars(self):
@@ -63,6 +175,18 @@ class ConfigService:
         self.plex_playlist_import_delay = float(os.getenv("PLEX_PLAYLIST_IMPORT_DELAY", "180"))
         logging.info(f"Plex Playlist Import Delay: {self.plex_playlist_import_delay}")
 
+        self.partial_scan = os.getenv("PARTIAL_SCAN", "True")
+        logging.info(f"Partial Scan: {self.partial_scan}")
+
+        self.partial_scan_max_paths = int(os.getenv("PARTIAL_SCAN_MAX_PATHS", "50"))
+        logging.info(f"Partial Scan Max Paths: {self.partial_scan_max_paths}")
+
+        self.media_refresh_debounce = float(os.getenv("MEDIA_REFRESH_DEBOUNCE", "30"))
+        logging.info(f"Media Refresh Debounce: {self.media_refresh_debounce}")
+
+        self.media_refresh_max_delay = float(os.getenv("MEDIA_REFRESH_MAX_DELAY", "300"))
+        logging.info(f"Media Refresh Max Delay: {self.media_refresh_max_delay}")
+
         self.generate_m3u_playlist = os.getenv("GENERATE_M3U_PLAYLIST", "True")
         logging.info(f"Generate M3U Playlist: {self.generate_m3u_playlist}")
 
@@ -78,15 +202,148 @@ class ConfigService:
         self.absolute_server_path = os.getenv("ABSOLUTE_SERVER_PATH", "/data/media/music/singles")
         logging.info(f"Absolute Server Path: {self.absolute_server_path}")
 
+        self.m3u_index_path = os.getenv("M3U_INDEX_PATH", "/config/m3u_index.json")
+        logging.info(f"M3U Index Path: {self.m3u_index_path}")
+
         self.supported_formats = {".mp3", ".flac", ".wav", ".aac", ".ogg", ".m4a", ".opus"}
         logging.info(f"Supported Formats: {self.supported_formats}")
 
+        self.passthrough_types = [item_type.strip() for item_type in os.getenv("PASSTHROUGH_TYPES", "").split(",") if item_type.strip() in ITEM_TYPES]
+        logging.info(f"Passthrough Types: {self.passthrough_types}")
+
+        self.passthrough_format = os.getenv("PASSTHROUGH_FORMAT", "opus")
+        if self.passthrough_format not in PASSTHROUGH_FORMATS:
+            logging.error(f"PASSTHROUGH_FORMAT must be one of {', '.join(PASSTHROUGH_FORMATS)}, using opus")
+            self.passthrough_format = "opus"
+        logging.info(f"Passthrough Format: {self.passthrough_format}")
+
         self.extra_logging = os.getenv("EXTRA_LOGGING", "False")
         logging.info(f"Extra Logging: {self.extra_logging}")
 
         self.search_limit = int(os.getenv("SEARCH_LIMIT", "10"))
         logging.info(f"Spotify Search Limit: {self.search_limit}")
 
+        self.search_cache_size = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+        logging.info(f"Search Cache Size: {self.search_cache_size}")
+
+        self.search_cache_ttl = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+        logging.info(f"Search Cache TTL: {self.search_cache_ttl}")
+
+        self.thumbnail_proxy = os.getenv("THUMBNAIL_PROXY", "True")
+        logging.info(f"Thumbnail Proxy: {self.thumbnail_proxy}")
+
+        self.thumbnail_size = int(os.getenv("THUMBNAIL_SIZE", "300"))
+        logging.info(f"Thumbnail Size: {self.thumbnail_size}")
+
+        self.thumbnail_cache_path = os.getenv("THUMBNAIL_CACHE_PATH", "/config/thumbnails")
+        logging.info(f"Thumbnail Cache Path: {self.thumbnail_cache_path}")
+
+        self.thumbnail_cache_mb = float(os.getenv("THUMBNAIL_CACHE_MB", "200"))
+        logging.info(f"Thumbnail Cache Size (MB): {self.thumbnail_cache_mb}")
+
+        self.spotify_pool_size = int(os.getenv("SPOTIFY_POOL_SIZE", "16"))
+        logging.info(f"Spotify Connection Pool Size: {self.spotify_pool_size}")
+
+        self.download_workers = max(1, int(os.getenv("DOWNLOAD_WORKERS", "2")))
+        logging.info(f"Download Workers: {self.download_workers}")
+
+        self.web_workers = max(1, int(os.getenv("WEB_WORKERS", "1")))
+        logging.info(f"Web Workers: {self.web_workers}")
+
+        self.download_runner = os.getenv("DOWNLOAD_RUNNER", "internal").lower()
+        if self.web_workers > 1 and self.download_runner != "separate":
+            # Every web worker would otherwise start its own downloaders and recover the others' jobs
+            logging.error("WEB_WORKERS above 1 needs DOWNLOAD_RUNNER=separate, using separate")
+            self.download_runner = "separate"
+        logging.info(f"Download Runner: {self.download_runner}")
+
+        self.socketio_message_queue = os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+        if self.download_runner == "separate" and not self.socketio_message_queue:
+            logging.error("DOWNLOAD_RUNNER=separate needs SOCKETIO_MESSAGE_QUEUE, download status will not reach the browser")
+        logging.info(f"Socket.IO Message Queue: {self.socketio_message_queue}")
+
+        self.runner_metrics_port = int(os.getenv("RUNNER_METRICS_PORT", "0"))
+        logging.info(f"Runner Metrics Port: {self.runner_metrics_port}")
+
+        self.download_engine = os.getenv("DOWNLOAD_ENGINE", "subprocess").lower()
+        logging.info(f"Download Engine: {self.download_engine}")
+
+        self.engine_max_jobs = int(os.getenv("ENGINE_MAX_JOBS", "50"))
+        logging.info(f"Engine Max Jobs: {self.engine_max_jobs}")
+
+        self.engine_max_memory_mb = float(os.getenv("ENGINE_MAX_MEMORY_MB", "1024"))
+        logging.info(f"Engine Max Memory (MB): {self.engine_max_memory_mb}")
+
+        self.batch_downloads = os.getenv("BATCH_DOWNLOADS", "False")
+        logging.info(f"Batch Downloads: {self.batch_downloads}")
+
+        self.batch_window = float(os.getenv("BATCH_WINDOW", "2"))
+        logging.info(f"Batch Window: {self.batch_window}")
+
+        self.batch_max_size = max(1, int(os.getenv("BATCH_MAX_SIZE", "25")))
+        logging.info(f"Batch Max Size: {self.batch_max_size}")
+
+        self.coalesce_requests = os.getenv("COALESCE_REQUESTS", "True")
+        logging.info(f"Coalesce Requests: {self.coalesce_requests}")
+
+        # Earlier types download first, types left out share the lowest class
+        self.queue_priority_order = [item_type.strip() for item_type in os.getenv("QUEUE_PRIORITY_ORDER", "track,album,playlist,artist").split(",") if item_type.strip() in ITEM_TYPES]
+        logging.info(f"Queue Priority Order: {self.queue_priority_order}")
+
+        self.queue_aging = float(os.getenv("QUEUE_AGING", "1800"))
+        logging.info(f"Queue Aging: {self.queue_aging}")
+
+        self.queue_fair_share = os.getenv("QUEUE_FAIR_SHARE", "True")
+        logging.info(f"Queue Fair Share: {self.queue_fair_share}")
+
+        self.library_index = os.getenv("LIBRARY_INDEX", "True")
+        logging.info(f"Library Index: {self.library_index}")
+
+        self.library_scan = os.getenv("LIBRARY_SCAN", "True")
+        logging.info(f"Library Scan: {self.library_scan}")
+
+        self.expand_collections = os.getenv("EXPAND_COLLECTIONS", "False")
+        logging.info(f"Expand Collections: {self.expand_collections}")
+
+        self.spotify_fetch_workers = max(1, int(os.getenv("SPOTIFY_FETCH_WORKERS", "4")))
+        logging.info(f"Spotify Fetch Workers: {self.spotify_fetch_workers}")
+
+        self.stream_all_search = os.getenv("STREAM_ALL_SEARCH", "True")
+        logging.info(f"Stream All Search: {self.stream_all_search}")
+
+        self.retry_max_attempts = max(0, int(os.getenv("RETRY_MAX_ATTEMPTS", "3")))
+        logging.info(f"Retry Max Attempts: {self.retry_max_attempts}")
+
+        self.retry_base_delay = float(os.getenv("RETRY_BASE_DELAY", "30"))
+        logging.info(f"Retry Base Delay: {self.retry_base_delay}")
+
+        self.retry_max_delay = float(os.getenv("RETRY_MAX_DELAY", "3600"))
+        logging.info(f"Retry Max Delay: {self.retry_max_delay}")
+
+        self.throttle_pause = float(os.getenv("THROTTLE_PAUSE", "600"))
+        logging.info(f"Throttle Pause: {self.throttle_pause}")
+
+        self.status_coalesce_window = float(os.getenv("STATUS_COALESCE_WINDOW", "0.25"))
+        logging.info(f"Status Coalesce Window: {self.status_coalesce_window}")
+
+        self.progress_interval = float(os.getenv("PROGRESS_INTERVAL", "1"))
+        logging.info(f"Progress Interval: {self.progress_interval}")
+
+        self.history_db_path = os.getenv("HISTORY_DB_PATH", "/config/spotspot.db")
+        logging.info(f"History Database Path: {self.history_db_path}")
+
+        self.history_max_rows = int(os.getenv("HISTORY_MAX_ROWS", "5000"))
+        logging.info(f"History Max Rows: {self.history_max_rows}")
+
+        self.history_max_age_days = float(os.getenv("HISTORY_MAX_AGE_DAYS", "30"))
+        logging.info(f"History Max Age (days): {self.history_max_age_days}")
+
+        self.settings_path = os.getenv("SETTINGS_PATH", "/config/settings.json")
+        logging.info(f"Settings Path: {self.settings_path}")
+
+        self.admin_token = os.getenv("ADMIN_TOKEN", "")
+        logging.info(f"Admin Token entered: {self.admin_token != ''}")
+
     def get_spotdl_vars(self):
         logging.info("Loading SpotDL Environmental Variables...")
 
@@ -185,6 +442,9 @@ class ConfigService:
 
         self.ffmpeg_args = os.getenv("FFMPEG_ARGS", None)
         logging.info(f"FFmpeg Args: {self.ffmpeg_args}")
+        if self.ffmpeg_args and self.passthrough_types and self.download_engine != "warm":
+            # The spotdl CLI cannot unset FFMPEG_ARGS per job, the warm engine can
+            logging.warning("FFMPEG_ARGS makes spotdl re-encode every file, passthrough downloads will be transcoded too")
 
         self.save_file = os.getenv("SAVE_FILE", None)
         logging.info(f"Save File: {self.save_file}")
@@ -380,8 +640,125 @@ class ConfigService:
     def create_config_file(self):
         try:
             os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-            with open(self.config_path, "w", encoding="utf-8") as config_file:
-                json.dump(self.spotdl_config, config_file, indent=4)
+            # Written aside and swapped in, spotdl runs may be reading the file during a reload
+            temp_path = f"{self.config_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as config_file:
+                with self.settings_lock:
+                    json.dump(self.spotdl_config, config_file, indent=4)
+            os.replace(temp_path, self.config_path)
             logging.info(f"Configuration saved to {self.config_path}")
         except Exception as e:
             logging.error(f"Failed to save config file: {e}")
+
+    def load_profiles(self):
+        self.download_profiles = {}
+        try:
+            profiles = json.loads(os.getenv("DOWNLOAD_PROFILES") or "{}")
+            self.download_profiles = {name: profile for name, profile in self.validate_profiles(profiles).items() if profile is not None}
+        except ValueError as e:
+            logging.error(f"Ignoring DOWNLOAD_PROFILES: {e}")
+        logging.info(f"Download Profiles: {', '.join(self.download_profiles) or 'None'}")
+
+    def load_saved_settings(self):
+        # Changes made at runtime are kept across restarts and win over the environment
+        if not os.path.exists(self.settings_path):
+            return
+        try:
+            with open(self.settings_path, "r", encoding="utf-8") as settings_file:
+                saved = json.load(settings_file)
+            self.update_settings(saved.get("settings"), saved.get("profiles"), save=False)
+            logging.info(f"Loaded saved settings from {self.settings_path}")
+        except Exception as e:
+            logging.error(f"Failed to load saved settings: {e}")
+
+    def validate_settings(self, settings, allowed):
+        if not isinstance(settings, dict):
+            raise ValueError("settings must be an object")
+        validated = {}
+        for name, value in settings.items():
+            if name not in allowed:
+                raise ValueError(f"{name} cannot be changed at runtime")
+            try:
+                validated[name] = allowed[name](value)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Invalid {name}: {e}")
+        return validated
+
+    def validate_profiles(self, profiles):
+        if not isinstance(profiles, dict):
+            raise ValueError("profiles must be an object")
+        validated = {}
+        for name, settings in profiles.items():
+            if not PROFILE_NAME.match(name):
+                raise ValueError(f"Invalid profile name {name}, use letters, numbers, - and _")
+            # A null profile removes it
+            validated[name] = None if settings is None else self.validate_settings(settings, PROFILE_SETTINGS)
+            for switch, value in (validated[name] or {}).items():
+                if switch in PROFILE_SWITCH_VALUES and value != PROFILE_SWITCH_VALUES[switch]:
+                    raise ValueError(f"Invalid {switch} in profile {name}: it can only be set to {str(PROFILE_SWITCH_VALUES[switch]).lower()}")
+        return validated
+
+    def update_settings(self, settings=None, profiles=None, save=True):
+        # Everything is validated first, so a bad value leaves the running config untouched
+        validated_settings = self.validate_settings(settings or {}, RELOADABLE_SETTINGS)
+        validated_profiles = self.validate_profiles(profiles or {})
+
+        with self.settings_lock:
+            for name, value in validated_settings.items():
+                setattr(self, name, value)
+                if name in self.spotdl_config:
+                    self.spotdl_config[name] = value
+                self.setting_overrides[name] = value
+            for name, profile in validated_profiles.items():
+                if profile is None:
+                    self.download_profiles.pop(name, None)
+                else:
+                    self.download_profiles[name] = profile
+                self.profile_overrides[name] = profile
+            self.settings_version += 1
+
+        logging.info(f"Settings updated: {validated_settings}, profiles updated: {list(validated_profiles)}")
+        if save:
+            self.save_settings()
+            self.create_config_file()
+        return {"settings": validated_settings, "profiles": validated_profiles}
+
+    def save_settings(self):
+        try:
+            settings_dir = os.path.dirname(self.settings_path)
+            if settings_dir:
+                os.makedirs(settings_dir, exist_ok=True)
+            with self.settings_lock:
+                saved = {"settings": self.setting_overrides, "profiles": self.profile_overrides}
+                with open(self.settings_path, "w", encoding="utf-8") as settings_file:
+                    json.dump(saved, settings_file, indent=4)
+        except Exception as e:
+            logging.error(f"Failed to save settings: {e}")
+
+    def get_profile(self, name):
+        with self.settings_lock:
+            profile = self.download_profiles.get(name)
+            if profile is None and name == PASSTHROUGH_PROFILE:
+                # spotdl moves a matching stream as is and only remuxes webm to opus when the bitrate is disabled
+                return {"format": self.passthrough_format, "bitrate": "disable", "ffmpeg_args": None}
+            return dict(profile) if profile is not None else None
+
+    def get_profile_names(self):
+        with self.settings_lock:
+            return sorted(set(self.download_profiles) | {PASSTHROUGH_PROFILE})
+
+    def get_default_profile(self, item_type):
+        with self.settings_lock:
+            return PASSTHROUGH_PROFILE if item_type in self.passthrough_types else None
+
+    def get_runtime_config(self):
+        with self.settings_lock:
+            return {
+                "version": self.settings_version,
+                "settings": {name: getattr(self, name) for name in RELOADABLE_SETTINGS},
+                "profiles": {name: dict(profile) for name, profile in self.download_profiles.items()},
+            }
+
+    def is_admin(self, token):
+        # Admin changes are disabled until ADMIN_TOKEN is set
+        return bool(self.admin_token) and bool(token) and hmac.compare_digest(str(token), self.admin_token)
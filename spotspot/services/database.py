@@ -0,0 +1,15 @@
+import os
+import sqlite3
+
+
+def open_database(config):
+    # History, queue, library index, process commands and thumbnail sources share one SQLite file
+    db_dir = os.path.dirname(config.history_db_path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+
+    connection = sqlite3.connect(config.history_db_path, check_same_thread=False, isolation_level=None, timeout=30)
+    # WAL lets the web workers read while the download runner writes
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
@@ -0,0 +1,359 @@
+import json
+import time
+import logging
+import threading
+from services.history_store import ACTIVE_STATUSES
+from services.database import open_database
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Queued jobs that can be handed out, with the running job count and last claim of their session
+SCHEDULE_FROM = """
+    FROM queue
+    LEFT JOIN (SELECT COALESCE(session, '') AS session, COUNT(*) AS jobs FROM queue WHERE state = 'claimed' GROUP BY 1) AS running ON running.session = COALESCE(queue.session, '')
+    LEFT JOIN queue_sessions ON queue_sessions.session = COALESCE(queue.session, '')
+    WHERE queue.state = 'queued' AND queue.available_at <= :now
+"""
+# Waiting jobs move up one priority class per aging interval, a bumped job (below 0) stays where it was put
+EFFECTIVE_PRIORITY = "MAX(queue.priority - CAST((:now - queue.enqueued_at) / :aging AS INTEGER), MIN(queue.priority, 0))"
+# Changes made by other processes show up in queue positions within this many seconds
+POSITIONS_MAX_AGE = 1
+
+
+class PersistentQueue:
+    def __init__(self, config, recover=True):
+        self.config = config
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.positions = {}
+        self.positions_at = 0
+        self.positions_changes = None
+
+        self.connection = open_database(self.config)
+        self.create_schema()
+        # Web workers next to a separate download runner must not hand back jobs it is still running
+        if recover:
+            self.requeue_claimed()
+
+    def create_schema(self):
+        with self.lock:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    history_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    enqueued_at REAL NOT NULL,
+                    claimed_at REAL
+                )
+                """
+            )
+            self.ensure_column("batch_key", "TEXT")
+            self.ensure_column("url_key", "TEXT")
+            self.ensure_column("available_at", "REAL NOT NULL DEFAULT 0")
+            self.ensure_column("priority", "INTEGER NOT NULL DEFAULT 0")
+            self.ensure_column("session", "TEXT")
+            self.ensure_column("parent_id", "INTEGER")
+            self.ensure_column("position", "REAL")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_queue_state ON queue (state, id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_queue_batch_key ON queue (state, batch_key, id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_queue_url_key ON queue (url_key)")
+            # Tracks of queued albums and playlists, and requests that ride along with a queued job
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queue_members (history_id INTEGER NOT NULL, track_id TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_queue_members_track ON queue_members (track_id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queue_attachments (history_id INTEGER NOT NULL, attached_id INTEGER NOT NULL, track_id TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_queue_attachments ON queue_attachments (history_id)")
+            # Global pause shared by every worker, set when YouTube or Spotify start throttling
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queue_pause (id INTEGER PRIMARY KEY CHECK (id = 1), paused_until REAL NOT NULL)")
+            # When each client session last had a job handed out, for fair sharing between sessions
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queue_sessions (session TEXT PRIMARY KEY, last_claimed_at REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_queue_parent ON queue (parent_id)")
+
+    def ensure_column(self, column, definition):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(queue)")]
+        if column not in columns:
+            self.connection.execute(f"ALTER TABLE queue ADD COLUMN {column} {definition}")
+
+    def requeue_claimed(self):
+        # Jobs claimed by a process that died never got acknowledged, hand them out again
+        start = time.perf_counter()
+        with self.lock:
+            cursor = self.connection.execute("UPDATE queue SET state = 'queued', claimed_at = NULL WHERE state = 'claimed'")
+            requeued = cursor.rowcount
+            pending = self.connection.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+        logging.info(f"Download queue restored: {pending} pending ({requeued} requeued) in {time.perf_counter() - start:.3f}s")
+
+    def put(self, download_info, batch_key=None, url_key=None, member_track_ids=None):
+        with self.not_empty:
+            self.connection.execute("BEGIN")
+            self.connection.execute(
+                "INSERT INTO queue (history_id, payload, enqueued_at, batch_key, url_key, priority, session, parent_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (download_info["id"], json.dumps(download_info), time.time(), batch_key, url_key, download_info.get("priority", 0), download_info.get("session"), download_info.get("parent_id")),
+            )
+            if member_track_ids:
+                self.connection.executemany("INSERT INTO queue_members (history_id, track_id) VALUES (?, ?)", ((download_info["id"], track_id) for track_id in member_track_ids))
+            self.connection.execute("COMMIT")
+            self.not_empty.notify()
+
+    def find_by_url_key(self, url_key):
+        with self.lock:
+            row = self.connection.execute("SELECT history_id FROM queue WHERE url_key = ? ORDER BY id LIMIT 1", (url_key,)).fetchone()
+        return row[0] if row else None
+
+    def find_containing(self, track_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT queue.history_id FROM queue_members JOIN queue ON queue.history_id = queue_members.history_id WHERE queue_members.track_id = ? ORDER BY queue.id LIMIT 1",
+                (track_id,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def attach(self, history_id, attached_id, track_id=None):
+        # Returns False once the job has its final status. Checked in the same transaction as the insert,
+        # so a worker in another process finishing the job either sees the attachment or makes this fail.
+        placeholders = ", ".join("?" for _ in ACTIVE_STATUSES)
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                active = self.connection.execute(f"SELECT 1 FROM history WHERE id = ? AND status IN ({placeholders})", (history_id, *ACTIVE_STATUSES)).fetchone()
+                if active:
+                    self.connection.execute("INSERT INTO queue_attachments (history_id, attached_id, track_id) VALUES (?, ?, ?)", (history_id, attached_id, track_id))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return bool(active)
+
+    def get_attachments(self, history_id):
+        with self.lock:
+            return self.connection.execute("SELECT attached_id, track_id FROM queue_attachments WHERE history_id = ?", (history_id,)).fetchall()
+
+    def clear_attachments(self, history_id):
+        # Returns the attachments removed, including any added since the final status was last synced
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                attachments = self.connection.execute("SELECT attached_id, track_id FROM queue_attachments WHERE history_id = ?", (history_id,)).fetchall()
+                self.connection.execute("DELETE FROM queue_attachments WHERE history_id = ?", (history_id,))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return attachments
+
+    def delete_job_data(self, history_ids):
+        self.connection.executemany("DELETE FROM queue_members WHERE history_id = ?", ((history_id,) for history_id in history_ids))
+        self.connection.executemany("DELETE FROM queue_attachments WHERE history_id = ?", ((history_id,) for history_id in history_ids))
+
+    def pause(self, paused_until):
+        with self.lock:
+            self.connection.execute("INSERT INTO queue_pause (id, paused_until) VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)", (paused_until,))
+
+    def get_paused_until(self):
+        row = self.connection.execute("SELECT paused_until FROM queue_pause WHERE id = 1").fetchone()
+        return row[0] if row and row[0] > time.time() else None
+
+    def is_paused(self):
+        with self.lock:
+            return self.get_paused_until() is not None
+
+    def retry_later(self, queue_id, download_info, delay):
+        # The job keeps its place in the queue but is not handed out before its delay has passed
+        with self.lock:
+            self.connection.execute(
+                "UPDATE queue SET state = 'queued', claimed_at = NULL, available_at = ?, payload = ? WHERE id = ?",
+                (time.time() + delay, json.dumps(download_info), queue_id),
+            )
+
+    def get_schedule_params(self):
+        return {"now": time.time(), "aging": self.config.queue_aging or 1e12}
+
+    def get_schedule_order(self):
+        # Jobs placed by hand keep their place within a class, ahead of the fair share order
+        order = [EFFECTIVE_PRIORITY, "queue.position IS NULL", "queue.position"]
+        if self.config.queue_fair_share.lower() == "true":
+            # Within a class the session with the fewest running jobs goes first, then the one served longest ago
+            order += ["COALESCE(running.jobs, 0)", "COALESCE(queue_sessions.last_claimed_at, 0)"]
+        order += ["queue.id"]
+        return ", ".join(order)
+
+    def try_claim(self):
+        if self.get_paused_until():
+            return None
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            params = self.get_schedule_params()
+            row = self.connection.execute(f"SELECT queue.id, queue.payload, COALESCE(queue.session, '') {SCHEDULE_FROM} ORDER BY {self.get_schedule_order()} LIMIT 1", params).fetchone()
+            if row:
+                self.connection.execute("UPDATE queue SET state = 'claimed', claimed_at = ? WHERE id = ?", (params["now"], row[0]))
+                self.connection.execute(
+                    "INSERT INTO queue_sessions (session, last_claimed_at) VALUES (?, ?) ON CONFLICT (session) DO UPDATE SET last_claimed_at = excluded.last_claimed_at", (row[2], params["now"])
+                )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        if not row:
+            return None
+        return row[0], json.loads(row[1])
+
+    def get_schedule(self):
+        # Queued jobs in the order they would be handed out, children of an expanded collection count as their parent
+        rows = self.connection.execute(
+            f"SELECT COALESCE(queue.parent_id, queue.history_id), queue.priority, queue.enqueued_at, queue.position, {EFFECTIVE_PRIORITY} {SCHEDULE_FROM} ORDER BY {self.get_schedule_order()}",
+            self.get_schedule_params(),
+        ).fetchall()
+        schedule = {}
+        for unit_id, priority, enqueued_at, position, effective_priority in rows:
+            schedule.setdefault(unit_id, (priority, enqueued_at, position, effective_priority))
+        return schedule
+
+    def get_positions(self, unit_ids):
+        # Every open status page asks for positions, the schedule is worked out once for all of them
+        with self.lock:
+            changes = self.connection.total_changes
+            if changes != self.positions_changes or time.monotonic() - self.positions_at >= POSITIONS_MAX_AGE:
+                self.positions = {unit_id: position for position, unit_id in enumerate(self.get_schedule(), start=1)}
+                self.positions_at = time.monotonic()
+                self.positions_changes = changes
+            return {unit_id: self.positions[unit_id] for unit_id in unit_ids if unit_id in self.positions}
+
+    def move(self, unit_id, direction, lowest_priority):
+        # Returns the new place in the queue, or None if the job is no longer waiting
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                schedule = self.get_schedule()
+                unit_ids = list(schedule)
+                if unit_id not in unit_ids:
+                    self.connection.execute("COMMIT")
+                    return None
+                index = unit_ids.index(unit_id)
+
+                if direction == "top":
+                    # Only jobs moved to the top share this class, the latest one goes first
+                    pinned = [position for _, _, position, _ in schedule.values() if position is not None]
+                    self.set_unit_order(unit_id, -1, schedule[unit_id][1], min(pinned, default=1) - 1)
+                elif direction == "bottom":
+                    self.set_unit_order(unit_id, lowest_priority, time.time(), None)
+                else:
+                    target = index - 1 if direction == "up" else index + 1
+                    if 0 <= target < len(unit_ids):
+                        self.pin_order(schedule, unit_ids, max(index, target))
+                        schedule = self.get_schedule()
+                        # Swapping class, aging clock and position swaps the two places exactly
+                        neighbour_id = unit_ids[target]
+                        self.set_unit_order(unit_id, *schedule[neighbour_id][:3])
+                        self.set_unit_order(neighbour_id, *schedule[unit_id][:3])
+                position = list(self.get_schedule()).index(unit_id) + 1
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return position
+
+    def pin_order(self, schedule, unit_ids, last_index):
+        # Placed jobs go ahead of the fair share order in their class, so only the swapped pair and the jobs
+        # ahead of them in the same class are fixed, everything behind them keeps following fair share
+        classes = {schedule[pinned_id][3] for pinned_id in unit_ids[last_index - 1 : last_index + 1]}
+        pinned_ids = [queued_id for index, queued_id in enumerate(unit_ids) if schedule[queued_id][3] in classes and (index <= last_index or schedule[queued_id][2] is not None)]
+        self.connection.executemany(
+            "UPDATE queue SET position = ? WHERE state = 'queued' AND COALESCE(parent_id, history_id) = ?", ((position, queued_id) for position, queued_id in enumerate(pinned_ids, start=1))
+        )
+
+    def set_unit_order(self, unit_id, priority, enqueued_at, position):
+        self.connection.execute(
+            "UPDATE queue SET priority = ?, enqueued_at = ?, position = ? WHERE state = 'queued' AND COALESCE(parent_id, history_id) = ?", (priority, enqueued_at, position, unit_id)
+        )
+
+    def raise_priority(self, unit_id, priority):
+        # A request that rides along with a queued job gives it the more urgent of the two classes
+        with self.lock:
+            self.connection.execute("UPDATE queue SET priority = MIN(priority, ?) WHERE state = 'queued' AND COALESCE(parent_id, history_id) = ?", (priority, unit_id))
+
+    def get(self):
+        with self.not_empty:
+            while True:
+                claimed = self.try_claim()
+                if claimed:
+                    return claimed
+                # Time out periodically so rows added by other processes are picked up
+                self.not_empty.wait(timeout=1)
+
+    def claim_matching(self, batch_key, limit):
+        if limit <= 0:
+            return []
+        with self.lock:
+            if self.get_paused_until():
+                return []
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT id, payload, COALESCE(session, '') FROM queue WHERE state = 'queued' AND batch_key = ? AND available_at <= ? ORDER BY id LIMIT ?", (batch_key, time.time(), limit)
+                ).fetchall()
+                now = time.time()
+                self.connection.executemany("UPDATE queue SET state = 'claimed', claimed_at = ? WHERE id = ?", ((now, row[0]) for row in rows))
+                self.connection.executemany(
+                    "INSERT INTO queue_sessions (session, last_claimed_at) VALUES (?, ?) ON CONFLICT (session) DO UPDATE SET last_claimed_at = excluded.last_claimed_at", {(row[2], now) for row in rows}
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def ack(self, queue_id):
+        # Returns the job's attachments, read in the same transaction that deletes them so none is lost
+        with self.lock:
+            # Reads before writing, so the write lock is taken up front or a commit from another connection fails it
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                history_ids = [row[0] for row in self.connection.execute("SELECT history_id FROM queue WHERE id = ?", (queue_id,))]
+                attachments = [
+                    attachment
+                    for history_id in history_ids
+                    for attachment in self.connection.execute("SELECT attached_id, track_id FROM queue_attachments WHERE history_id = ?", (history_id,)).fetchall()
+                ]
+                self.connection.execute("DELETE FROM queue WHERE id = ?", (queue_id,))
+                self.delete_job_data(history_ids)
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return attachments
+
+    def clear_pending(self):
+        # Returns the cancelled jobs and the IDs of requests attached to them
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            rows = self.connection.execute("SELECT history_id, payload FROM queue WHERE state = 'queued'").fetchall()
+            history_ids = [row[0] for row in rows]
+            attached_ids = [row[0] for row in self.connection.execute("SELECT attached_id FROM queue_attachments JOIN queue ON queue.history_id = queue_attachments.history_id WHERE queue.state = 'queued'")]
+            self.connection.execute("DELETE FROM queue WHERE state = 'queued'")
+            self.delete_job_data(history_ids)
+            self.connection.execute("COMMIT")
+        return [json.loads(row[1]) for row in rows], attached_ids
+
+    def get_pending_history_ids(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT history_id FROM queue UNION SELECT attached_id FROM queue_attachments")]
+
+    def empty(self):
+        # Jobs waiting for a retry do not hold back the media server refresh
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM queue WHERE state = 'queued' AND available_at <= ? LIMIT 1", (time.time(),)).fetchone() is None
+
+    def get_depths(self):
+        depths = {"queued": 0, "delayed": 0, "claimed": 0}
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT CASE WHEN state = 'claimed' THEN 'claimed' WHEN available_at > ? THEN 'delayed' ELSE 'queued' END, COUNT(*) FROM queue GROUP BY 1", (time.time(),)
+            ).fetchall()
+        depths.update(rows)
+        return depths
+
+    def qsize(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM queue WHERE state = 'queued'").fetchone()[0]
@@ -1,146 +1,736 @@
-import sys
+import os
+import re
+import time
 import logging
+import tempfile
+import threading
 import subprocess
+from services.history_store import RETRYABLE_STATUSES
+from services.retry_policy import THROTTLE_MAX_RETRIES, classify_failure, get_retry_after, backoff_delay
+from services.metrics import JOB_DURATION, JOB_START_DURATION
+from services.status_broadcaster import StatusBroadcaster
+from services.spotdl_engine import SpotdlEngineWorker, EngineCancelled
+from services.spotdl_output import SpotdlProgress, stream_process_output
+from services.spotify_urls import get_track_id, get_url_key
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# spotdl flags for download profile settings, switches can only turn on what config.json leaves off
+PROFILE_OPTIONS = {"format": "--format", "bitrate": "--bitrate", "threads": "--threads", "max_retries": "--max-retries", "ffmpeg_args": "--ffmpeg-args", "yt_dlp_args": "--yt-dlp-args"}
+PROFILE_LISTS = {"audio_providers": "--audio", "lyrics_providers": "--lyrics"}
+PROFILE_SWITCHES = {"sponsor_block": "--sponsor-block", "generate_lrc": "--generate-lrc", "skip_album_art": "--skip-album-art", "only_verified_results": "--only-verified-results"}
+MOVE_DIRECTIONS = ("top", "up", "down", "bottom")
+
 
 class DownloadService:
-    def __init__(self, config, playlist_manager, socketio, download_queue, download_history):
+    def __init__(self, config, playlist_manager, socketio, download_queue, history_store, spotify_service, library_index, run_downloads=True):
         self.config = config
         self.playlist_manager = playlist_manager
         self.socketio = socketio
         self.download_queue = download_queue
-        self.download_history = download_history
-        self.spodtdl_subprocess = None
+        self.history_store = history_store
+        self.spotify_service = spotify_service
+        self.library_index = library_index
+        self.active_subprocesses = {}
+        self.active_jobs = 0
+        self.active_lock = threading.Lock()
+        self.changed_paths = set()
+        self.engine_workers = {}
+        self.throttle_count = 0
+        self.queue_lock = threading.RLock()
+        self.status_broadcaster = StatusBroadcaster(self.socketio, self.config.status_coalesce_window, self.config.progress_interval, self.history_store)
+        # Web workers only queue jobs when a separate download runner executes them
+        self.run_downloads = run_downloads
+        if run_downloads:
+            self.restore_queue()
+            self.start_library_scan()
+
+    def restore_queue(self):
+        # History marks unfinished jobs as interrupted on startup, flip the ones still queued back
+        pending_ids = self.download_queue.get_pending_history_ids()
+        if pending_ids:
+            self.history_store.set_status_many(pending_ids, "Pending...")
+            for parent_id in self.history_store.get_parent_ids(pending_ids):
+                self.update_parent(parent_id)
+            logging.info(f"Resuming {len(pending_ids)} queued downloads")
+
+    def start_library_scan(self):
+        if not self.library_index.is_enabled() or self.config.library_scan.lower() != "true":
+            return
+        output_paths = (self.config.track_output, self.config.album_output, self.config.playlist_output, self.config.artist_output)
+        scan_roots = [self.get_template_root(output_path) for output_path in output_paths]
+        threading.Thread(target=self.library_index.scan_roots, args=(scan_roots,), daemon=True).start()
+
+    def is_coalescing(self):
+        return self.config.coalesce_requests.lower() == "true"
+
+    def is_expanding(self, item_type):
+        return self.config.expand_collections.lower() == "true" and item_type in ("album", "playlist", "artist")
+
+    def get_request_key(self, spotify_url, profile):
+        # The same item under another profile is a different file, so it is not coalesced
+        url_key = get_url_key(spotify_url)
+        return f"{url_key}#{profile}" if profile else url_key
+
+    def get_batch_key(self, download_info):
+        download_path = self.get_job_download_path(download_info)
+        return f"{download_path}#{download_info['profile']}" if download_info.get("profile") else download_path
+
+    def get_priority(self, item_type, requested=None):
+        # Lower classes download first, a request can ask for another type's class or a class number
+        order = self.config.queue_priority_order
+        if requested in order:
+            return order.index(requested)
+        if isinstance(requested, int) and not isinstance(requested, bool):
+            return min(max(requested, 0), len(order))
+        return order.index(item_type) if item_type in order else len(order)
+
+    def get_profile_settings(self, download_info):
+        profile = download_info.get("profile")
+        if not profile:
+            return {}
+        profile_settings = self.config.get_profile(profile)
+        if profile_settings is None:
+            logging.error(f"Download profile {profile} no longer exists, using the default settings")
+            return {}
+        return profile_settings
+
+    def get_profile_args(self, profile_settings):
+        profile_args = []
+        for name, value in profile_settings.items():
+            if name in PROFILE_OPTIONS and value is not None:
+                profile_args += [PROFILE_OPTIONS[name], str(value)]
+            elif name in PROFILE_LISTS:
+                profile_args += [PROFILE_LISTS[name], *value]
+            elif name in PROFILE_SWITCHES and value:
+                profile_args.append(PROFILE_SWITCHES[name])
+            elif name == "filter_results" and not value:
+                profile_args.append("--dont-filter-results")
+        return profile_args
+
+    def get_collection_tracks(self, item_type, spotify_url):
+        # Needed to expand collections, to find tracks inside queued collections and to skip tracks already on disk
+        if not self.is_expanding(item_type):
+            if item_type not in ("album", "playlist"):
+                return None
+            if not self.is_coalescing() and not (self.library_index.is_enabled() and self.library_index.count()):
+                return None
+        try:
+            return self.spotify_service.get_collection_items(item_type, spotify_url)
+        except Exception as e:
+            logging.error(f"Collection Tracks Error: {str(e)}")
+            return None
+
+    def check_library(self, item_type, spotify_url, collection_tracks, profile=None):
+        # Returns the track IDs already on disk and whether that covers the whole item
+        if not self.library_index.is_enabled():
+            return [], False
+
+        try:
+            # A profile is a different file, only a copy in its format counts as downloaded
+            profile_settings = self.config.get_profile(profile) if profile else None
+            file_format = profile_settings.get("format") if profile_settings else None
+
+            if item_type == "track":
+                track_id = get_track_id(spotify_url)
+                return [], bool(self.library_index.find_present([(track_id, None)], file_format))
+
+            if collection_tracks:
+                present = self.library_index.find_present([(track["id"], track["isrc"]) for track in collection_tracks], file_format)
+                logging.info(f"Library has {len(present)} of {len(collection_tracks)} tracks for {spotify_url}")
+                return sorted(present), len(present) == len(collection_tracks)
+
+        except Exception as e:
+            logging.error(f"Library Check Error: {str(e)}")
+        return [], False
+
+    def get_status_snapshot(self, page=1, page_size=50, status=None):
+        # Read before the page, so any change the page might miss arrives as a newer patch
+        version = self.status_broadcaster.get_version()
+        history_page = self.history_store.get_page(page, page_size, status)
+        snapshot = self.status_broadcaster.snapshot(history_page.pop("history"), version)
+        snapshot.update(history_page)
+        positions = self.get_queue_positions([item["id"] for item in snapshot["history"] if item["status"] == "Pending..."])
+        for item in snapshot["history"]:
+            if item["id"] in positions:
+                item["queue_position"] = positions[item["id"]]
+        return snapshot
+
+    def get_queue_positions(self, history_ids):
+        if not history_ids:
+            return {}
+        return self.download_queue.get_positions(history_ids)
+
+    def set_status(self, download_info, status):
+        download_info["status"] = status
+        self.history_store.update_status(download_info)
+        # Child tracks are not listed on the status page, their parent shows the totals
+        if not download_info.get("parent_id"):
+            self.status_broadcaster.item_changed(download_info)
+        for attached_id, track_id in self.download_queue.get_attachments(download_info["id"]):
+            self.set_attached_status(attached_id, track_id, status)
+        if download_info.get("parent_id"):
+            self.update_parent(download_info["parent_id"])
+
+    def set_attached_status(self, attached_id, track_id, status):
+        # A track riding along with an album or playlist finished if its file is now in the library
+        if track_id and status in ("Complete", "Failed") and self.library_index.is_enabled():
+            status = "Complete" if self.library_index.find_present([(track_id, None)]) else "Failed"
+        attached_info = self.history_store.get(attached_id)
+        if attached_info and attached_info["status"] != status:
+            self.set_status(attached_info, status)
+
+    def attach_request(self, download_info, parent_id, track_id=None):
+        parent_info = self.history_store.get(parent_id)
+        download_info["status"] = parent_info["status"] if parent_info else "Pending..."
+        self.history_store.add(download_info)
+        if not download_info.get("parent_id"):
+            self.status_broadcaster.item_changed(download_info)
+        if not self.download_queue.attach(parent_id, download_info["id"], track_id):
+            # The job finished after it was found, the request takes its final status straight away
+            final_info = self.history_store.get(parent_id)
+            self.set_attached_status(download_info["id"], track_id, final_info["status"] if final_info else "Failed")
+            return parent_info or {"name": "another download"}
+        logging.info(f"Request for {download_info['url']} attached to queued download {parent_id}")
+        return parent_info or {"name": "another download"}
+
+    def update_parent(self, parent_id):
+        # Works out an expanded collection's status from its child tracks
+        with self.queue_lock:
+            parent_info = self.history_store.get(parent_id)
+            if not parent_info:
+                return
+            counts = self.history_store.get_child_counts(parent_id)
+            total = sum(counts.values())
+            completed = counts.get("Complete", 0) + counts.get("Already Downloaded", 0)
+            failed = counts.get("Failed", 0) + counts.get("Error", 0)
+            pending = counts.get("Pending...", 0)
+            active = pending + counts.get("Downloading...", 0) + counts.get("Retrying...", 0)
+
+            if active:
+                status = "Pending..." if pending == total else "Downloading..."
+            elif failed:
+                status = "Failed"
+            elif completed == total:
+                status = "Complete"
+            else:
+                status = "Cancelled"
+
+            if parent_info["status"] != status:
+                self.set_status(parent_info, status)
+                if not active:
+                    for attached_id, attached_track_id in self.download_queue.clear_attachments(parent_id):
+                        self.set_attached_status(attached_id, attached_track_id, status)
+
+        item_ids = [parent_id] + [attached_id for attached_id, _ in self.download_queue.get_attachments(parent_id)]
+        self.status_broadcaster.progress_changed(item_ids, {"completed": completed, "failed": failed, "total": total, "current": None})
+
+    def get_child_download_path(self, download_info, position, total):
+        # Child jobs download single tracks, so spotdl no longer knows which playlist they came from
+        list_name = re.sub(r'[\\/:*?"<>|]', "", download_info["name"] or "").strip()
+        download_path = self.get_download_path(download_info["type"])
+        return download_path.replace("{list-name}", list_name).replace("{list-position}", str(position).zfill(len(str(total)))).replace("{list-length}", str(total))
+
+    def queue_collection(self, download_info, collection_tracks, present_track_ids):
+        # One child job per track, so a failed track can be retried on its own
+        download_info["url_key"] = self.get_request_key(download_info["url"], download_info.get("profile"))
+        self.history_store.add(download_info)
+        self.status_broadcaster.item_changed(download_info)
+
+        queued = attached = 0
+        for position, track in enumerate(collection_tracks, start=1):
+            child_info = {
+                "name": track["name"],
+                "type": "track",
+                "artist": track["artist"],
+                "url": track["url"],
+                "status": "Pending...",
+                "parent_id": download_info["id"],
+                "url_key": self.get_request_key(track["url"], download_info.get("profile")),
+                "download_path": self.get_child_download_path(download_info, position, len(collection_tracks)),
+                "profile": download_info.get("profile"),
+                "priority": download_info.get("priority", 0),
+                "session": download_info.get("session"),
+            }
+            if track["id"] in present_track_ids:
+                child_info["status"] = "Already Downloaded"
+                self.history_store.add(child_info)
+                continue
+
+            existing_id = self.download_queue.find_by_url_key(child_info["url_key"]) if self.is_coalescing() else None
+            if existing_id:
+                self.attach_request(child_info, existing_id)
+                attached += 1
+                continue
+
+            self.history_store.add(child_info)
+            self.download_queue.put(child_info, self.get_batch_key(child_info), child_info["url_key"])
+            queued += 1
+
+        self.update_parent(download_info["id"])
+        logging.info(f"Expanded {download_info['url']} into {len(collection_tracks)} tracks: {queued} queued, {attached} attached, {len(present_track_ids)} already downloaded")
+        return queued, attached
 
-    def add_item_to_queue(self, data):
+    def attach_to_queued(self, download_info, url_key):
+        parent_id = self.download_queue.find_by_url_key(url_key) or self.history_store.find_active_parent(url_key)
+        if not parent_id:
+            return None
+        self.attach_request(download_info, parent_id)
+        self.download_queue.raise_priority(parent_id, download_info["priority"])
+        return {"title": "Already Queued", "body": f"{download_info['name']} is already queued, this request follows that download"}
+
+    def add_item_to_queue(self, data, session=None):
         logging.info(f"Download Requested: {data}")
 
         spotify_url = data.get("url")
         item_type = data.get("type")
         item_name = data.get("name")
         item_artist = data.get("artist")
+        profile = data.get("profile") or self.config.get_default_profile(item_type)
+
+        if profile and self.config.get_profile(profile) is None:
+            return {"title": "Unknown Profile", "body": f"There is no download profile called {profile}"}
 
         download_info = {"name": item_name, "type": item_type, "artist": item_artist, "url": spotify_url, "status": "Pending..."}
+        # Browsers send a lasting client ID so a reload does not count as a new session
+        download_info["priority"] = self.get_priority(item_type, data.get("priority"))
+        download_info["session"] = data.get("client_id") or session
+        if profile:
+            download_info["profile"] = profile
+        url_key = self.get_request_key(spotify_url, profile)
+        track_id = get_track_id(spotify_url)
+
+        if self.is_coalescing():
+            with self.queue_lock:
+                queue_notice = self.attach_to_queued(download_info, url_key)
+            if queue_notice:
+                return queue_notice
+
+        # A big playlist takes many Spotify calls, fetched without the lock so workers and other requests are not held up
+        collection_tracks = self.get_collection_tracks(item_type, spotify_url)
+        present_track_ids, fully_present = self.check_library(item_type, spotify_url, collection_tracks, profile)
+
+        # Held until the job is queued so two clicks on the same item cannot both get through
+        with self.queue_lock:
+            if self.is_coalescing():
+                # The same item may have been queued while the tracks were fetched
+                queue_notice = self.attach_to_queued(download_info, url_key)
+                if queue_notice:
+                    return queue_notice
+
+            if fully_present:
+                download_info["status"] = "Already Downloaded"
+                self.history_store.add(download_info)
+                self.status_broadcaster.item_changed(download_info)
+                logging.info(f"Already downloaded, skipping: {spotify_url}")
+                return {"title": "Already Downloaded", "body": f"{item_name} is already in the library"}
+
+            if self.is_coalescing() and track_id:
+                parent_id = self.download_queue.find_containing(track_id)
+                if parent_id and (self.history_store.get(parent_id) or {}).get("profile") == profile:
+                    parent_info = self.attach_request(download_info, parent_id, track_id)
+                    self.download_queue.raise_priority(parent_id, download_info["priority"])
+                    return {"title": "Already Queued", "body": f"{item_name} is part of {parent_info['name']}, which is already queued"}
+
+            if self.is_expanding(item_type) and collection_tracks:
+                queued, attached = self.queue_collection(download_info, collection_tracks, set(present_track_ids))
+                return {"title": "Download Queued", "body": f"{item_name}: {queued} tracks queued, {attached} already queued elsewhere, {len(present_track_ids)} already in the library"}
+
+            if present_track_ids:
+                # spotdl drops archived songs before matching them on YouTube, so only missing tracks are fetched
+                download_info["skip_track_ids"] = present_track_ids
+
+            member_track_ids = [track["id"] for track in collection_tracks or []]
+            self.history_store.add(download_info)
+            self.download_queue.put(download_info, self.get_batch_key(download_info), url_key, member_track_ids)
+            self.status_broadcaster.item_changed(download_info)
+
+        if present_track_ids:
+            return {"title": "Download Queued", "body": f"{len(present_track_ids)} tracks of {item_name} are already in the library and will be skipped"}
+
+    def process_downloads(self, worker_id=0):
+        logging.info(f"Download worker {worker_id} started")
+        while True:
+            try:
+                self.process_next_download(worker_id)
+            except Exception as e:
+                # A database error such as a lock timeout must not end the worker, the next job is tried again
+                logging.error(f"Download Worker {worker_id} Error: {str(e)}")
+                time.sleep(1)
 
-        self.download_queue.put((spotify_url, download_info))
-        self.download_history[spotify_url] = download_info
+    def process_next_download(self, worker_id):
+        queue_id, download_info = self.download_queue.get()
+        claimed_at = time.monotonic()
+        batch = [(queue_id, download_info)]
 
-        self.socketio.emit("update_status", {"history": list(self.download_history.values())})
+        with self.active_lock:
+            self.active_jobs += 1
 
-    def process_downloads(self):
-        while True:
-            url, download_info = self.download_queue.get()
+        try:
+            try:
+                if self.is_batchable(download_info):
+                    batch += self.collect_batch(download_info)
+                self.download_items(worker_id, [info for _, info in batch], claimed_at)
+            finally:
+                job_duration = time.monotonic() - claimed_at
+                with self.queue_lock:
+                    for batch_queue_id, batch_info in batch:
+                        JOB_DURATION.labels(batch_info["type"], batch_info["status"]).observe(job_duration)
+                        if batch_info["status"] == "Retrying...":
+                            self.download_queue.retry_later(batch_queue_id, batch_info, batch_info.pop("retry_delay", 0))
+                            continue
+                        # Requests attached after the final status was set still need to see it
+                        for attached_id, attached_track_id in self.download_queue.ack(batch_queue_id):
+                            self.set_attached_status(attached_id, attached_track_id, batch_info["status"])
+        finally:
+            # Kept apart from the acks above, a failed ack must not leave the queue looking busy for good
+            with self.active_lock:
+                self.active_jobs -= 1
+
+        with self.active_lock:
+            queue_drained = self.active_jobs == 0 and self.download_queue.empty()
+            changed_paths = None
+            if queue_drained:
+                changed_paths = self.changed_paths
+                self.changed_paths = set()
+
+        if queue_drained:
+            logging.info("Queue is empty")
+            self.playlist_manager.media_server_refresh_check(changed_paths)
+
+    def get_job_download_path(self, download_info):
+        return download_info.get("download_path") or self.get_download_path(download_info["type"])
+
+    def get_download_path(self, item_type):
+        if item_type == "track":
+            return self.config.track_output
+        elif item_type == "playlist":
+            return self.config.playlist_output
+        elif item_type == "album":
+            return self.config.album_output
+        elif item_type == "artist":
+            return self.config.artist_output
+
+    def is_batchable(self, download_info):
+        # Only single tracks can be mapped back to their own row from spotdl's archive
+        return self.config.batch_downloads.lower() == "true" and download_info["type"] == "track"
+
+    def collect_batch(self, download_info):
+        batch = []
+        batch_key = self.get_batch_key(download_info)
+        deadline = time.monotonic() + self.config.batch_window
+        while len(batch) + 1 < self.config.batch_max_size:
+            batch += self.download_queue.claim_matching(batch_key, self.config.batch_max_size - len(batch) - 1)
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(min(0.25, max(0, deadline - time.monotonic())))
+
+        if batch:
+            logging.info(f"Batched {len(batch) + 1} tracks into one spotdl run")
+        return batch
+
+    def read_archived_track_ids(self, archive_path):
+        try:
+            with open(archive_path, "r", encoding="utf-8") as archive_file:
+                return {get_track_id(line.strip()) for line in archive_file if line.strip()}
+        except OSError:
+            return set()
 
-            if download_info["status"] == "Cancelled":
-                self.download_queue.task_done()
-                continue
+    def get_skip_urls(self, download_infos):
+        return [f"https://open.spotify.com/track/{track_id}" for download_info in download_infos for track_id in download_info.get("skip_track_ids", [])]
 
-            if download_info["type"] == "track":
-                download_path = self.config.track_output
-            elif download_info["type"] == "playlist":
-                download_path = self.config.playlist_output
-            elif download_info["type"] == "album":
-                download_path = self.config.album_output
-            elif download_info["type"] == "artist":
-                download_path = self.config.artist_output
+    def get_template_root(self, download_path):
+        # Deepest directory of the output template that does not depend on track metadata
+        static_part = download_path.split("{", 1)[0]
+        return os.path.dirname(static_part) or static_part
 
-            download_info["status"] = "Downloading..."
-            self.download_history[url] = download_info
-            self.socketio.emit("update_status", {"history": list(self.download_history.values())})
+    def read_m3u_files(self, m3u_path):
+        try:
+            with open(m3u_path, "r", encoding="utf-8") as m3u_file:
+                return [os.path.abspath(line.strip()) for line in m3u_file if line.strip() and not line.startswith("#")]
+        except OSError:
+            return []
+
+    def get_output_dirs(self, output_files, download_path):
+        output_dirs = {os.path.dirname(output_file) for output_file in output_files}
+        if not output_dirs and self.get_template_root(download_path):
+            output_dirs.add(self.get_template_root(download_path))
+        return output_dirs or None
+
+    def record_output_dirs(self, output_dirs):
+        # None means the job's folders are unknown, which forces a full library scan
+        logging.info(f"Output directories written: {sorted(output_dirs) if output_dirs else 'unknown'}")
+        with self.active_lock:
+            if output_dirs is None or self.changed_paths is None:
+                self.changed_paths = None
+            else:
+                self.changed_paths.update(output_dirs)
+
+    def register_active(self, download_infos, process):
+        with self.active_lock:
+            for download_info in download_infos:
+                self.active_subprocesses[download_info["id"]] = (download_info, process)
+
+    def observe_job_start(self, claimed_at):
+        JOB_START_DURATION.labels(self.config.download_engine).observe(time.monotonic() - claimed_at)
+
+    def run_spotdl_subprocess(self, download_infos, urls, download_path, claimed_at):
+        # spotdl lists every file it wrote or found in this m3u, which tells us where the job landed
+        job_name = f"spotspot-job-{download_infos[0]['id']}"
+        temp_m3u_path = os.path.join(tempfile.gettempdir(), f"{job_name}.m3u8")
+        # A fresh archive collects the Spotify URLs spotdl finished, used to split batch results per track
+        archive_path = os.path.join(tempfile.gettempdir(), f"{job_name}.archive")
+        temp_paths = [archive_path]
 
-            try:
-                logging.info(f"Downloading: {url}")
+        try:
+            command = ["spotdl", "--output", f"{download_path}"]
+            if self.config.m3u:
+                # spotdl writes a single m3u, so the user's own M3U setting wins and is read back when its name is fixed
+                m3u_path = None if "{" in self.config.m3u else self.config.m3u
+            else:
+                m3u_path = temp_m3u_path
+                temp_paths.append(temp_m3u_path)
+                command += ["--m3u", m3u_path]
+            command += self.get_profile_args(self.get_profile_settings(download_infos[0]))
+            skip_urls = self.get_skip_urls(download_infos)
+            if len(download_infos) > 1 or skip_urls:
+                with open(archive_path, "w", encoding="utf-8") as archive_file:
+                    archive_file.write("".join(f"{skip_url}\n" for skip_url in skip_urls))
+                command += ["--archive", archive_path]
+            command += urls
+            logging.info(f"SpotDL command: {command}")
+
+            # A wide console stops spotdl's rich output from wrapping the lines the progress parser reads
+            spotdl_env = dict(os.environ, COLUMNS="1000")
+            spotdl_subprocess = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=spotdl_env)
+            self.observe_job_start(claimed_at)
+            self.register_active(download_infos, spotdl_subprocess)
+
+            item_ids = [download_info["id"] for download_info in download_infos]
+            item_ids += [attached_id for item_id in list(item_ids) for attached_id, _ in self.download_queue.get_attachments(item_id)]
+            track_count = len(download_infos) if download_infos[0]["type"] == "track" else 0
+            progress = SpotdlProgress(track_count)
+            extra_logging = self.config.extra_logging.lower() == "true"
+
+            def handle_line(stream_name, line):
+                if extra_logging:
+                    if stream_name == "stdout":
+                        logging.info(f"SpotDL Output: {line.strip()}")
+                    else:
+                        logging.error(f"SpotDL Error Log: {line.strip()}")
+                if progress.feed(line):
+                    self.status_broadcaster.progress_changed(item_ids, progress.to_dict())
+
+            stderr = stream_process_output(spotdl_subprocess, handle_line)
+            if extra_logging:
+                logging.info(f"No more SpotDL Logs available")
+
+            output_files = self.read_m3u_files(m3u_path) if m3u_path else []
+            if self.library_index.is_enabled():
+                self.library_index.add_files(output_files)
+
+            return {
+                "returncode": spotdl_subprocess.returncode,
+                "stderr": stderr,
+                "output_dirs": self.get_output_dirs(output_files, download_path),
+                "finished_track_ids": self.read_archived_track_ids(archive_path),
+            }
 
-                command = ["spotdl", "--output", f"{download_path}", url]
-                logging.info(f"SpotDL command: {command}")
+        finally:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
 
-                self.spodtdl_subprocess = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    def run_engine_job(self, worker_id, download_infos, urls, download_path, claimed_at):
+        # Each worker keeps its own engine process, so spotdl's startup is paid once per worker
+        engine_worker = self.engine_workers.get(worker_id)
+        if engine_worker is None:
+            engine_worker = self.engine_workers[worker_id] = SpotdlEngineWorker(self.config, worker_id)
+        self.register_active(download_infos, engine_worker.begin_job())
 
-                if self.config.extra_logging.lower() == "false":
-                    stdout, stderr = self.spodtdl_subprocess.communicate()
-                else:
-                    while True and self.config.extra_logging.lower() == "true":
-                        stdout_line = self.spodtdl_subprocess.stdout.readline()
-                        stderr_line = self.spodtdl_subprocess.stderr.readline()
+        try:
+            result = engine_worker.run_job(urls, download_path, self.get_skip_urls(download_infos), lambda: self.observe_job_start(claimed_at), self.get_profile_settings(download_infos[0]))
+        except EngineCancelled:
+            return None
 
-                        if stdout_line:
-                            logging.info(f"SpotDL Output: {stdout_line.strip()}")
-                            sys.stdout.flush()
+        finished_songs = [song for song in result["songs"] if song["path"]]
+        if self.library_index.is_enabled():
+            self.library_index.add_tracks([(song["song_id"], song["isrc"], os.path.abspath(song["path"])) for song in finished_songs])
 
-                        if stderr_line:
-                            logging.error(f"SpotDL Error Log: {stderr_line.strip()}")
-                            sys.stderr.flush()
+        # Skipped tracks are already on disk, which counts as finished for a batch
+        finished_track_ids = {song["song_id"] for song in finished_songs}
+        finished_track_ids.update(get_track_id(skip_url) for skip_url in self.get_skip_urls(download_infos))
 
-                        if stdout_line == "" and stderr_line == "" and self.spodtdl_subprocess.poll() is not None:
-                            logging.info(f"No more SpotDL Logs available")
-                            break
+        return {
+            "returncode": result["returncode"],
+            "stderr": result["error"],
+            "output_dirs": self.get_output_dirs([os.path.abspath(song["path"]) for song in finished_songs], download_path),
+            "finished_track_ids": finished_track_ids,
+        }
 
-                if download_info["status"] == "Cancelled":
-                    self.download_queue.task_done()
-                    continue
+    def download_items(self, worker_id, download_infos, claimed_at):
+        download_path = self.get_job_download_path(download_infos[0])
+        urls = [download_info["url"] for download_info in download_infos]
+
+        for download_info in download_infos:
+            self.set_status(download_info, "Downloading...")
+
+        try:
+            logging.info(f"Worker {worker_id} Downloading: {urls}")
+
+            if self.config.download_engine == "warm":
+                outcome = self.run_engine_job(worker_id, download_infos, urls, download_path, claimed_at)
+            else:
+                outcome = self.run_spotdl_subprocess(download_infos, urls, download_path, claimed_at)
+
+            if outcome is None or all(download_info["status"] == "Cancelled" for download_info in download_infos):
+                return
+
+            self.record_output_dirs(outcome["output_dirs"])
+            stderr = outcome["stderr"]
+            failure = classify_failure(outcome["returncode"], stderr)
 
-                if self.spodtdl_subprocess.returncode == 0:
-                    download_info["status"] = "Complete"
+            if len(download_infos) == 1:
+                if outcome["returncode"] == 0:
+                    self.set_status(download_infos[0], "Complete")
+                    self.throttle_count = 0
                     logging.info(f"Finished Item")
                 else:
-                    download_info["status"] = "Failed"
                     logging.error(f"Error downloading: {stderr}")
+                    if failure == "throttled" and download_infos[0].get("throttle_retries", 0) < THROTTLE_MAX_RETRIES:
+                        self.pause_for_throttle(stderr)
+                    self.fail_or_retry(download_infos[0], failure)
+                return
 
-                self.download_history[url] = download_info
-
-            except Exception as e:
-                logging.error(f"Process Downloads Error: {str(e)}")
-                download_info["status"] = "Error"
-                self.download_history[url] = download_info
-
-            self.socketio.emit("update_status", {"history": list(self.download_history.values())})
+            finished_track_ids = outcome["finished_track_ids"]
+            if failure == "throttled" and len(finished_track_ids) < len(download_infos):
+                self.pause_for_throttle(stderr)
+            for download_info in download_infos:
+                if download_info["status"] == "Cancelled":
+                    continue
+                if get_track_id(download_info["url"]) in finished_track_ids:
+                    self.set_status(download_info, "Complete")
+                    self.throttle_count = 0
+                else:
+                    logging.error(f"Error downloading {download_info['url']} in batch: {stderr}")
+                    self.fail_or_retry(download_info, failure)
+            logging.info(f"Finished batch of {len(download_infos)} tracks, {len(finished_track_ids)} complete")
 
-            self.download_queue.task_done()
+        except Exception as e:
+            logging.error(f"Process Downloads Error: {str(e)}")
+            for download_info in download_infos:
+                self.set_status(download_info, "Error")
 
-            if self.download_queue.empty():
-                logging.info("Queue is empty")
-                self.playlist_manager.media_server_refresh_check()
+        finally:
+            with self.active_lock:
+                for download_info in download_infos:
+                    self.active_subprocesses.pop(download_info["id"], None)
+
+    def fail_or_retry(self, download_info, failure):
+        # Throttled jobs wait out the global pause without using up an attempt
+        attempts = download_info.get("attempts", 0)
+        throttle_retries = download_info.get("throttle_retries", 0)
+        if failure == "throttled" and throttle_retries < THROTTLE_MAX_RETRIES:
+            download_info["throttle_retries"] = throttle_retries + 1
+            download_info["retry_delay"] = 0
+            logging.info(f"Retrying {download_info['url']} once the queue resumes (throttled {throttle_retries + 1} of {THROTTLE_MAX_RETRIES})")
+        elif failure == "transient" and attempts < self.config.retry_max_attempts:
+            download_info["attempts"] = attempts + 1
+            download_info["retry_delay"] = backoff_delay(attempts + 1, self.config.retry_base_delay, self.config.retry_max_delay)
+            logging.info(f"Retrying {download_info['url']} in {download_info['retry_delay']:.0f}s (retry {attempts + 1} of {self.config.retry_max_attempts})")
+        else:
+            self.set_status(download_info, "Failed")
+            return
+
+        self.set_status(download_info, "Retrying...")
+
+    def pause_for_throttle(self, stderr):
+        # Every job would hit the same limit, so the whole queue waits and the wait grows while throttling continues
+        self.throttle_count += 1
+        retry_after = get_retry_after(stderr)
+        pause = retry_after or min(self.config.retry_max_delay, self.config.throttle_pause * 2 ** (self.throttle_count - 1))
+        self.download_queue.pause(time.time() + pause)
+        logging.error(f"Download source is throttling requests, pausing the queue for {pause:.0f}s")
+        resume_in = f"{round(pause / 60)} minutes" if pause >= 120 else f"{pause:.0f} seconds"
+        self.socketio.emit("toast", {"title": "Downloads Paused", "body": f"Too many requests, downloads resume in {resume_in}"})
 
     def cancel_active_download(self):
         try:
-            if not self.spodtdl_subprocess:
+            with self.active_lock:
+                active_subprocesses = dict(self.active_subprocesses)
+                self.active_subprocesses.clear()
+
+            if not active_subprocesses:
                 logging.info(f"No active download.")
                 return
 
-            logging.info(f"Cancelling active download.")
-            self.spodtdl_subprocess.terminate()
-
-            # Find the active download in history and update its status
-            for url, info in self.download_history.items():
-                if info["status"] == "Downloading...":
-                    info["status"] = "Cancelled"
-                    self.download_history[url] = info
-                    break
-
-            self.spodtdl_subprocess = None
+            logging.info(f"Cancelling {len(active_subprocesses)} active download(s).")
+            for download_info, spotdl_subprocess in active_subprocesses.values():
+                # Mark as cancelled before terminating so the worker does not report a failure
+                self.set_status(download_info, "Cancelled")
+                spotdl_subprocess.terminate()
 
         except Exception as e:
             logging.error(f"Cancel Active Error: {str(e)}")
 
-        finally:
-            self.socketio.emit("update_status", {"history": list(self.download_history.values())})
-
     def cancel_pending_downloads(self):
         try:
-            temp_queue = []
-            while not self.download_queue.empty():
-                url, download_info = self.download_queue.get()
+            cancelled, attached_ids = self.download_queue.clear_pending()
+            self.history_store.set_status_many([download_info["id"] for download_info in cancelled] + attached_ids, "Cancelled")
+            for download_info in cancelled:
                 download_info["status"] = "Cancelled"
-                self.download_history[url] = download_info
-                temp_queue.append((url, download_info))
-
-            for item in temp_queue:
-                self.download_queue.put(item)
+                if not download_info.get("parent_id"):
+                    self.status_broadcaster.item_changed(download_info)
+            for attached_id in attached_ids:
+                attached_info = self.history_store.get(attached_id)
+                if attached_info and not attached_info.get("parent_id"):
+                    self.status_broadcaster.item_changed(attached_info)
+            for parent_id in self.history_store.get_parent_ids([download_info["id"] for download_info in cancelled] + attached_ids):
+                self.update_parent(parent_id)
+            logging.info(f"Cancelled {len(cancelled)} pending download(s).")
 
         except Exception as e:
             logging.error(f"Cancel Pending Error: {str(e)}")
 
-        finally:
-            self.socketio.emit("update_status", {"history": list(self.download_history.values())})
+    def requeue(self, download_info, session=None):
+        download_info["status"] = "Pending..."
+        download_info["url_key"] = download_info.get("url_key") or self.get_request_key(download_info["url"], download_info.get("profile"))
+        # Tracks of an expanded collection keep the collection's class
+        parent_info = self.history_store.get(download_info["parent_id"]) if download_info.get("parent_id") else None
+        download_info["priority"] = self.get_priority((parent_info or download_info)["type"])
+        download_info["session"] = session
+        self.history_store.update_status(download_info)
+        self.download_queue.put(download_info, self.get_batch_key(download_info), download_info["url_key"])
+
+    def retry_item(self, history_id, session=None):
+        # Retrying an expanded collection only runs the tracks that did not make it
+        try:
+            with self.queue_lock:
+                download_info = self.history_store.get(history_id)
+                if not download_info:
+                    return
+                if self.history_store.get_child_counts(history_id):
+                    children = self.history_store.get_children(history_id, RETRYABLE_STATUSES)
+                    for child_info in children:
+                        self.requeue(child_info, session)
+                    self.update_parent(history_id)
+                    logging.info(f"Retrying {len(children)} tracks of {download_info['name']}")
+                elif download_info["status"] in RETRYABLE_STATUSES:
+                    self.requeue(download_info, session)
+                    self.status_broadcaster.item_changed(download_info)
+                    logging.info(f"Retrying {download_info['name']}")
+
+        except Exception as e:
+            logging.error(f"Retry Error: {str(e)}")
+
+    def move_item(self, history_id, direction):
+        if direction not in MOVE_DIRECTIONS:
+            return None
+        try:
+            # Moving below the last class keeps a job at the back even as it ages
+            position = self.download_queue.move(history_id, direction, len(self.config.queue_priority_order) + 1)
+            if position:
+                logging.info(f"Moved {history_id} {direction}, now number {position} in the queue")
+            return position
+        except Exception as e:
+            logging.error(f"Move Error: {str(e)}")
@@ -0,0 +1,222 @@
+import time
+import sqlite3
+import logging
+import threading
+from services.database import open_database
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+ACTIVE_STATUSES = ("Pending...", "Downloading...", "Retrying...")
+RETRYABLE_STATUSES = ("Failed", "Error", "Cancelled", "Interrupted")
+
+
+class HistoryStore:
+    def __init__(self, config, recover=True):
+        self.config = config
+        self.lock = threading.Lock()
+        self.adds_since_prune = 0
+
+        self.connection = open_database(self.config)
+        self.connection.row_factory = sqlite3.Row
+        self.create_schema()
+        # Only the process running downloads knows which active jobs died with the last run
+        if recover:
+            self.mark_interrupted()
+        self.prune()
+        logging.info(f"Download history stored in: {self.config.history_db_path}")
+
+    def create_schema(self):
+        with self.lock:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    name TEXT,
+                    type TEXT,
+                    artist TEXT,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self.ensure_column("parent_id", "INTEGER")
+            self.ensure_column("url_key", "TEXT")
+            self.ensure_column("download_path", "TEXT")
+            self.ensure_column("profile", "TEXT")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_history_status ON history (status, created_at)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_history_created ON history (created_at)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_history_parent ON history (parent_id, status)")
+            # Status patch numbering shared by every process that publishes changes
+            self.connection.execute("CREATE TABLE IF NOT EXISTS status_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+            self.connection.execute("INSERT OR IGNORE INTO status_version (id, version) VALUES (1, 0)")
+
+    def ensure_column(self, column, definition):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(history)")]
+        if column not in columns:
+            self.connection.execute(f"ALTER TABLE history ADD COLUMN {column} {definition}")
+
+    def mark_interrupted(self):
+        # Jobs left active by a previous run can no longer complete
+        with self.lock:
+            placeholders = ", ".join("?" for _ in ACTIVE_STATUSES)
+            cursor = self.connection.execute(f"UPDATE history SET status = 'Interrupted', updated_at = ? WHERE status IN ({placeholders})", (time.time(), *ACTIVE_STATUSES))
+        if cursor.rowcount:
+            logging.info(f"Marked {cursor.rowcount} unfinished downloads from a previous run as interrupted")
+
+    def next_status_version(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("UPDATE status_version SET version = version + 1 WHERE id = 1")
+                version = self.connection.execute("SELECT version FROM status_version WHERE id = 1").fetchone()[0]
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return version
+
+    def get_status_version(self):
+        with self.lock:
+            return self.connection.execute("SELECT version FROM status_version WHERE id = 1").fetchone()[0]
+
+    def row_to_item(self, row):
+        return {key: row[key] for key in row.keys()}
+
+    def add(self, download_info):
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO history (url, name, type, artist, status, created_at, updated_at, parent_id, url_key, download_path, profile) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    download_info["url"],
+                    download_info["name"],
+                    download_info["type"],
+                    download_info["artist"],
+                    download_info["status"],
+                    now,
+                    now,
+                    download_info.get("parent_id"),
+                    download_info.get("url_key"),
+                    download_info.get("download_path"),
+                    download_info.get("profile"),
+                ),
+            )
+            download_info["id"] = cursor.lastrowid
+            download_info["created_at"] = now
+            self.adds_since_prune += 1
+            prune_due = self.adds_since_prune >= 100
+
+        if prune_due:
+            self.prune()
+        return download_info["id"]
+
+    def update_status(self, download_info):
+        with self.lock:
+            self.connection.execute("UPDATE history SET status = ?, updated_at = ? WHERE id = ?", (download_info["status"], time.time(), download_info["id"]))
+
+    def set_status_many(self, item_ids, status):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("UPDATE history SET status = ?, updated_at = ? WHERE id = ?", ((status, now, item_id) for item_id in item_ids))
+            self.connection.execute("COMMIT")
+
+    def get(self, item_id):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM history WHERE id = ?", (item_id,)).fetchone()
+        return self.row_to_item(row) if row else None
+
+    def get_children(self, parent_id, statuses=None):
+        query, params = "SELECT * FROM history WHERE parent_id = ?", [parent_id]
+        if statuses:
+            query += f" AND status IN ({', '.join('?' for _ in statuses)})"
+            params += list(statuses)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY id", params).fetchall()
+        return [self.row_to_item(row) for row in rows]
+
+    def get_child_counts(self, parent_id):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM history WHERE parent_id = ? GROUP BY status", (parent_id,)).fetchall())
+
+    def get_status_counts(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM history GROUP BY status").fetchall())
+
+    def get_parent_ids(self, item_ids):
+        parent_ids = set()
+        with self.lock:
+            for start in range(0, len(item_ids), 500):
+                chunk = item_ids[start : start + 500]
+                rows = self.connection.execute(f"SELECT DISTINCT parent_id FROM history WHERE parent_id IS NOT NULL AND id IN ({', '.join('?' for _ in chunk)})", chunk)
+                parent_ids.update(row[0] for row in rows)
+        return parent_ids
+
+    def find_active_parent(self, url_key):
+        placeholders = ", ".join("?" for _ in ACTIVE_STATUSES)
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT id FROM history WHERE url_key = ? AND parent_id IS NULL AND status IN ({placeholders}) AND EXISTS (SELECT 1 FROM history AS child WHERE child.parent_id = history.id) ORDER BY id LIMIT 1",
+                (url_key, *ACTIVE_STATUSES),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_page(self, page=1, page_size=50, status=None):
+        page = max(1, int(page))
+        page_size = min(max(1, int(page_size)), 500)
+
+        # Child tracks of expanded collections are summed up on their parent row
+        where, params = "WHERE parent_id IS NULL", []
+        if status:
+            where, params = "WHERE parent_id IS NULL AND status = ?", [status]
+
+        with self.lock:
+            total = self.connection.execute(f"SELECT COUNT(*) FROM history {where}", params).fetchone()[0]
+            rows = self.connection.execute(
+                f"SELECT * FROM history {where} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size],
+            ).fetchall()
+
+        return {"history": [self.row_to_item(row) for row in rows], "total": total, "page": page, "page_size": page_size, "status": status}
+
+    def prune(self):
+        # Only finished jobs are removed, anything pending or downloading is kept. Tracks of an expanded
+        # collection do not count against the limits and go together with their finished parent.
+        try:
+            with self.lock:
+                self.adds_since_prune = 0
+                placeholders = ", ".join("?" for _ in ACTIVE_STATUSES)
+                deleted = 0
+
+                if self.config.history_max_age_days > 0:
+                    cutoff = time.time() - self.config.history_max_age_days * 86400
+                    cursor = self.connection.execute(
+                        f"DELETE FROM history WHERE parent_id IS NULL AND created_at < ? AND status NOT IN ({placeholders})", (cutoff, *ACTIVE_STATUSES)
+                    )
+                    deleted += cursor.rowcount
+
+                if self.config.history_max_rows > 0:
+                    cursor = self.connection.execute(
+                        f"""
+                        DELETE FROM history WHERE parent_id IS NULL AND status NOT IN ({placeholders}) AND id IN (
+                            SELECT id FROM history WHERE parent_id IS NULL ORDER BY created_at DESC, id DESC LIMIT -1 OFFSET ?
+                        )
+                        """,
+                        (*ACTIVE_STATUSES, self.config.history_max_rows),
+                    )
+                    deleted += cursor.rowcount
+
+                if deleted:
+                    cursor = self.connection.execute(
+                        f"DELETE FROM history WHERE parent_id IS NOT NULL AND status NOT IN ({placeholders}) AND parent_id NOT IN (SELECT id FROM history WHERE parent_id IS NULL)",
+                        ACTIVE_STATUSES,
+                    )
+                    deleted += cursor.rowcount
+
+            if deleted:
+                logging.info(f"Pruned {deleted} old download history entries")
+
+        except Exception as e:
+            logging.error(f"History Prune Error: {str(e)}")
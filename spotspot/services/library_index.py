@@ -0,0 +1,168 @@
+import os
+import time
+import logging
+import threading
+import mutagen
+from mutagen.id3 import ID3
+from mutagen.mp4 import MP4
+from services.spotify_urls import get_track_id
+from services.database import open_database
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class LibraryIndex:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+
+        self.connection = open_database(self.config)
+        self.create_schema()
+
+    def create_schema(self):
+        with self.lock:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS library_tracks (
+                    track_id TEXT PRIMARY KEY,
+                    isrc TEXT,
+                    path TEXT NOT NULL,
+                    added_at REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_library_isrc ON library_tracks (isrc)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS library_scans (root TEXT PRIMARY KEY, files INTEGER NOT NULL, scanned_at REAL NOT NULL)")
+
+    def is_enabled(self):
+        return self.config.library_index.lower() == "true"
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM library_tracks").fetchone()[0]
+
+    def read_track_tags(self, path):
+        # spotdl embeds the Spotify URL and ISRC in every file it writes, MP3 tags are read without parsing the audio
+        if path.lower().endswith(".mp3"):
+            audio_file = None
+            tags = ID3(path)
+        else:
+            audio_file = mutagen.File(path)
+            if audio_file is None or audio_file.tags is None:
+                return None, None
+            tags = audio_file.tags
+
+        if isinstance(tags, ID3):
+            url_frames = tags.getall("WOAS")
+            isrc_frames = tags.getall("TSRC")
+            url = getattr(url_frames[0], "url", None) if url_frames else None
+            isrc = str(isrc_frames[0].text[0]) if isrc_frames and isrc_frames[0].text else None
+        elif isinstance(audio_file, MP4):
+            url_values = tags.get("----:spotdl:WOAS")
+            isrc_values = tags.get("----:spotdl:ISRC")
+            url = bytes(url_values[0]).decode("utf-8", "replace") if url_values else None
+            isrc = bytes(isrc_values[0]).decode("utf-8", "replace") if isrc_values else None
+        else:
+            url = (tags.get("woas") or [None])[0]
+            isrc = (tags.get("isrc") or [None])[0]
+
+        return get_track_id(url), isrc or None
+
+    def add_tracks(self, tracks):
+        # tracks are (track_id, isrc, path) tuples, files without a Spotify ID cannot be matched later
+        rows = [(track_id, isrc, path, time.time()) for track_id, isrc, path in tracks if track_id and path]
+        if not rows:
+            return 0
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT OR REPLACE INTO library_tracks (track_id, isrc, path, added_at) VALUES (?, ?, ?, ?)", rows)
+            self.connection.execute("COMMIT")
+        return len(rows)
+
+    def add_files(self, paths):
+        tracks = []
+        for path in paths:
+            try:
+                track_id, isrc = self.read_track_tags(path)
+                tracks.append((track_id, isrc, path))
+            except Exception as e:
+                logging.error(f"Library Tag Read Error for {path}: {str(e)}")
+        return self.add_tracks(tracks)
+
+    def find_present(self, tracks, file_format=None):
+        # tracks are (track_id, isrc) tuples, returns the IDs that are already on disk by either key
+        tracks = [(track_id, isrc) for track_id, isrc in tracks if track_id]
+        if not tracks:
+            return set()
+
+        rows = []
+        with self.lock:
+            for start in range(0, len(tracks), 500):
+                chunk = tracks[start : start + 500]
+                track_ids = [track_id for track_id, _ in chunk]
+                isrcs = [isrc for _, isrc in chunk if isrc]
+                query = f"SELECT track_id, isrc, path FROM library_tracks WHERE track_id IN ({', '.join('?' for _ in track_ids)})"
+                if isrcs:
+                    query += f" OR isrc IN ({', '.join('?' for _ in isrcs)})"
+                rows += self.connection.execute(query, track_ids + isrcs).fetchall()
+
+        # A file that was deleted or moved no longer counts
+        present_ids, present_isrcs, stale_ids = set(), set(), []
+        for track_id, isrc, path in rows:
+            if os.path.exists(path):
+                # A file in another format does not satisfy a profile that asks for a specific one
+                if file_format and os.path.splitext(path)[1].lower() != f".{file_format.lower()}":
+                    continue
+                present_ids.add(track_id)
+                if isrc:
+                    present_isrcs.add(isrc)
+            else:
+                stale_ids.append(track_id)
+        if stale_ids:
+            self.remove(stale_ids)
+
+        return {track_id for track_id, isrc in tracks if track_id in present_ids or (isrc and isrc in present_isrcs)}
+
+    def remove(self, track_ids):
+        with self.lock:
+            self.connection.executemany("DELETE FROM library_tracks WHERE track_id = ?", ((track_id,) for track_id in track_ids))
+
+    def mark_downloaded(self, parsed_results):
+        # Search results are cached, so flag copies of the track entries instead of the cached ones
+        if not parsed_results or not parsed_results.get("tracks") or not self.is_enabled():
+            return parsed_results
+
+        present = self.find_present([(track.get("id"), track.get("isrc")) for track in parsed_results["tracks"]])
+        marked_results = dict(parsed_results)
+        marked_results["tracks"] = [dict(track, downloaded=track.get("id") in present) for track in parsed_results["tracks"]]
+        return marked_results
+
+    def scan_roots(self, roots):
+        # One-off tag scan of each output root, later downloads are added as they complete
+        with self.lock:
+            scanned = {row[0] for row in self.connection.execute("SELECT root FROM library_scans")}
+
+        for root in sorted(set(roots)):
+            if not root or root in scanned or any(root.startswith(parent.rstrip(os.sep) + os.sep) for parent in roots if parent and parent != root):
+                continue
+            if not os.path.isdir(root):
+                logging.info(f"Library scan skipped, folder does not exist: {root}")
+                continue
+
+            start = time.perf_counter()
+            files = indexed = 0
+            batch = []
+            for folder, _, file_names in os.walk(root):
+                for file_name in file_names:
+                    if os.path.splitext(file_name)[1].lower() not in self.config.supported_formats:
+                        continue
+                    files += 1
+                    batch.append(os.path.join(folder, file_name))
+                    if len(batch) >= 500:
+                        indexed += self.add_files(batch)
+                        batch = []
+            indexed += self.add_files(batch)
+
+            with self.lock:
+                self.connection.execute("INSERT OR REPLACE INTO library_scans (root, files, scanned_at) VALUES (?, ?, ?)", (root, files, time.time()))
+            logging.info(f"Library scan of {root}: {indexed} of {files} files indexed in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,61 @@
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from socketio.packet import Packet, EVENT
+
+JOB_DURATION = Histogram(
+    "spotspot_job_duration_seconds",
+    "Time a download job spends from being claimed to its final status",
+    ["type", "status"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200),
+)
+JOB_START_DURATION = Histogram(
+    "spotspot_job_start_seconds",
+    "Time from a job being claimed to spotdl starting on it",
+    ["engine"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+SEARCH_DURATION = Histogram("spotspot_spotify_search_seconds", "Spotify search latency", ["search_type", "cache"])
+SEARCH_ERRORS = Counter("spotspot_spotify_search_errors_total", "Spotify searches that raised an error", ["search_type"])
+MEDIA_SERVER_DURATION = Histogram(
+    "spotspot_media_server_request_seconds",
+    "Latency of Plex and Jellyfin library refreshes and playlist imports",
+    ["server", "action"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+MEDIA_SERVER_ERRORS = Counter("spotspot_media_server_errors_total", "Failed Plex and Jellyfin requests", ["server", "action"])
+SOCKETIO_EMITS = Counter("spotspot_socketio_emits_total", "Socket.IO events sent, a broadcast counts once", ["event"])
+SOCKETIO_EMIT_BYTES = Counter("spotspot_socketio_emit_bytes_total", "Encoded size of Socket.IO events sent", ["event"])
+
+
+class MeteredPacket(Packet):
+    # A broadcast is encoded once for all clients, so this counts emits without serializing anything twice
+    def encode(self):
+        encoded_packet = super().encode()
+        if self.packet_type == EVENT and self.data:
+            event = str(self.data[0])
+            SOCKETIO_EMITS.labels(event).inc()
+            SOCKETIO_EMIT_BYTES.labels(event).inc(sum(len(part) for part in encoded_packet) if isinstance(encoded_packet, list) else len(encoded_packet))
+        return encoded_packet
+
+
+class QueueCollector:
+    # Queue and history figures are read from the database when scraped, so they are always current
+    def __init__(self, download_service):
+        self.download_service = download_service
+
+    def collect(self):
+        queue_depth = GaugeMetricFamily("spotspot_queue_depth", "Jobs in the download queue by state", labels=["state"])
+        for state, count in self.download_service.download_queue.get_depths().items():
+            queue_depth.add_metric([state], count)
+        yield queue_depth
+
+        # Worker figures only exist in the process running downloads, a separate runner reports them on RUNNER_METRICS_PORT
+        if self.download_service.run_downloads:
+            yield GaugeMetricFamily("spotspot_active_workers", "Download workers running a job", value=self.download_service.active_jobs)
+            yield GaugeMetricFamily("spotspot_download_workers", "Configured download workers", value=self.download_service.config.download_workers)
+        yield GaugeMetricFamily("spotspot_queue_paused", "1 while the queue is paused after throttling", value=1 if self.download_service.download_queue.is_paused() else 0)
+
+        history_status = GaugeMetricFamily("spotspot_history_jobs", "Jobs in the download history by status", labels=["status"])
+        for status, count in self.download_service.history_store.get_status_counts().items():
+            history_status.add_metric([status], count)
+        yield history_status
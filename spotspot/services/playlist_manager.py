@@ -1,15 +1,71 @@
 import os
+import json
+import hashlib
 import logging
 import requests
 import threading
 from plexapi.server import PlexServer
+from services.refresh_scheduler import RefreshScheduler
+from services.metrics import MEDIA_SERVER_DURATION, MEDIA_SERVER_ERRORS
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# Bumped when the index layout changes, an older index is rebuilt
+M3U_INDEX_VERSION = 2
+
 
 class PlaylistManager:
     def __init__(self, config):
         self.config = config
+        self.m3u_index = None
+        self.http_session = requests.Session()
+        self.plex_server = None
+        self.plex_import_timer = None
+        self.plex_import_lock = threading.Lock()
+        self.refresh_scheduler = RefreshScheduler(config, self.run_media_server_refresh)
+
+    def load_m3u_index(self, folder_path):
+        if self.m3u_index is None:
+            try:
+                with open(self.config.m3u_index_path, "r", encoding="utf-8") as index_file:
+                    self.m3u_index = json.load(index_file)
+            except (OSError, ValueError):
+                self.m3u_index = {}
+
+        if self.m3u_index.get("folder") != folder_path or self.m3u_index.get("version") != M3U_INDEX_VERSION:
+            self.m3u_index = {"version": M3U_INDEX_VERSION, "folder": folder_path, "dir_mtime": None, "entries": {}, "digest": None, "playlist_state": None}
+        return self.m3u_index
+
+    def save_m3u_index(self):
+        try:
+            os.makedirs(os.path.dirname(self.config.m3u_index_path), exist_ok=True)
+            temp_path = f"{self.config.m3u_index_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as index_file:
+                json.dump(self.m3u_index, index_file)
+            os.replace(temp_path, self.config.m3u_index_path)
+        except Exception as e:
+            logging.error(f"M3U Index Save Error: {str(e)}")
+
+    def scan_playlist_folder(self, folder_path, index):
+        # Only new or replaced files need a stat call. scandir returns the inode for free, and a file
+        # re-downloaded under the same name gets a new one, so its recorded mtime is refreshed.
+        known_entries = index["entries"]
+        entries = {}
+        new_files = 0
+        with os.scandir(folder_path) as folder_entries:
+            for entry in folder_entries:
+                if os.path.splitext(entry.name)[1].lower() not in self.config.supported_formats or not entry.is_file():
+                    continue
+                known = known_entries.get(entry.name)
+                if known and known[1] == entry.inode():
+                    mtime = known[0]
+                else:
+                    mtime = entry.stat().st_mtime
+                    new_files += 1
+                entries[entry.name] = [mtime, entry.inode()]
+
+        logging.info(f"Playlist folder scanned: {len(entries)} files, {new_files} new, {len(known_entries) + new_files - len(entries)} removed")
+        return entries
 
     def generate_m3u_playlist(self):
         try:
@@ -22,12 +78,19 @@ class PlaylistManager:
             m3u_file_path = os.path.join(self.config.m3u_playlist_path, f"{self.config.m3u_playlist_name}.m3u")
             logging.info(f"M3U playlist file: {m3u_file_path}")
 
-            # Get list of files with their modification times
-            files = []
-            for file in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, file)
-                if os.path.isfile(file_path) and any(file.lower().endswith(ext) for ext in self.config.supported_formats):
-                    files.append((file_path, file, os.path.getmtime(file_path)))
+            # The folder mtime changes whenever a file is added, removed or renamed in it
+            index = self.load_m3u_index(folder_path)
+            dir_mtime = os.stat(folder_path).st_mtime_ns
+            playlist_state = [dir_mtime, self.config.m3u_playlist_sort_order, m3u_file_path]
+            if index.get("playlist_state") == playlist_state and os.path.exists(m3u_file_path):
+                logging.info(f"Playlist folder unchanged since last scan, M3U playlist is up to date")
+                return
+
+            if index["dir_mtime"] != dir_mtime:
+                index["entries"] = self.scan_playlist_folder(folder_path, index)
+                index["dir_mtime"] = dir_mtime
+
+            files = [(os.path.join(folder_path, file), file, mtime) for file, (mtime, _) in index["entries"].items()]
 
             # Apply sorting based on environment variable
             if self.config.m3u_playlist_sort_order == "name_asc":
@@ -39,39 +102,104 @@ class PlaylistManager:
             else:
                 files.sort(key=lambda x: x[2], reverse=True)
 
-            # Write sorted files to M3U playlist
-            with open(m3u_file_path, "w") as m3u_file:
-                for file_path, _, _ in files:
-                    m3u_file.write(f"{file_path}\n")
+            content = "".join(f"{file_path}\n" for file_path, _, _ in files)
+            digest = hashlib.sha1(f"{m3u_file_path}\0{content}".encode("utf-8")).hexdigest()
+
+            if digest == index.get("digest") and os.path.exists(m3u_file_path):
+                logging.info(f"M3U playlist unchanged: {m3u_file_path}")
+            else:
+                # Write sorted files to M3U playlist, replacing the old file in one step
+                temp_path = f"{m3u_file_path}.tmp"
+                with open(temp_path, "w") as m3u_file:
+                    m3u_file.write(content)
+                os.replace(temp_path, m3u_file_path)
+                index["digest"] = digest
+                logging.info(f"M3U playlist generated at: {m3u_file_path}")
 
-            logging.info(f"M3U playlist generated at: {m3u_file_path}")
+            index["playlist_state"] = playlist_state
+            self.save_m3u_index()
 
         except Exception as e:
             logging.error(f"Playlist Generation Error: {str(e)}")
 
-    def refresh_plex_library(self):
+    def get_plex_server(self):
+        if self.plex_server is None:
+            self.plex_server = PlexServer(self.config.plex_address, self.config.plex_token, session=self.http_session)
+        return self.plex_server
+
+    def get_scan_paths(self, changed_paths):
+        # None means a full scan, nested folders are covered by their parent's partial scan
+        if not changed_paths or self.config.partial_scan.lower() != "true":
+            return None
+
+        scan_paths = []
+        for path in sorted(os.path.normpath(path) for path in changed_paths):
+            if not any(path == parent or path.startswith(parent.rstrip(os.sep) + os.sep) for parent in scan_paths):
+                scan_paths.append(path)
+
+        if len(scan_paths) > self.config.partial_scan_max_paths:
+            logging.info(f"{len(scan_paths)} changed folders exceed PARTIAL_SCAN_MAX_PATHS, using a full library scan")
+            return None
+        return scan_paths
+
+    def refresh_plex_library(self, scan_paths=None):
         try:
+            with MEDIA_SERVER_DURATION.labels("plex", "connect").time():
+                library_section = self.get_plex_server().library.section(self.config.plex_library_name)
+            if scan_paths:
+                try:
+                    with MEDIA_SERVER_DURATION.labels("plex", "partial_scan").time():
+                        for path in scan_paths:
+                            library_section.update(path=path)
+                    logging.info(f"Plex partial scan for '{self.config.plex_library_name}' started for {len(scan_paths)} folder(s): {scan_paths}")
+                    return
+                except Exception as e:
+                    MEDIA_SERVER_ERRORS.labels("plex", "partial_scan").inc()
+                    logging.error(f"Plex partial scan error, falling back to a full scan: {str(e)}")
+
             logging.info("Refreshing Plex library...")
-            plex_server = PlexServer(self.config.plex_address, self.config.plex_token)
-            library_section = plex_server.library.section(self.config.plex_library_name)
-            library_section.update()
+            with MEDIA_SERVER_DURATION.labels("plex", "scan").time():
+                library_section.update()
             logging.info(f"Plex Library scan for '{self.config.plex_library_name}' started.")
 
         except Exception as e:
+            # Drop the cached connection so the next refresh reconnects
+            self.plex_server = None
+            MEDIA_SERVER_ERRORS.labels("plex", "scan").inc()
             logging.error(f"Plex scan error: {str(e)}")
 
-    def refresh_jellyfin_library(self):
+    def refresh_jellyfin_library(self, scan_paths=None):
+        if scan_paths:
+            try:
+                url = f"{self.config.jellyfin_address}/Library/Media/Updated?api_key={self.config.jellyfin_api_key}"
+                updates = {"Updates": [{"Path": path, "UpdateType": "Created"} for path in scan_paths]}
+                with MEDIA_SERVER_DURATION.labels("jellyfin", "partial_scan").time():
+                    response = self.http_session.post(url, json=updates, timeout=30)
+
+                if response.status_code == 204:
+                    logging.info(f"Jellyfin notified of {len(scan_paths)} updated folder(s): {scan_paths}")
+                    return
+                MEDIA_SERVER_ERRORS.labels("jellyfin", "partial_scan").inc()
+                logging.error(f"Jellyfin partial scan failed, falling back to a full refresh: {response.status_code} - {response.text}")
+
+            except Exception as e:
+                MEDIA_SERVER_ERRORS.labels("jellyfin", "partial_scan").inc()
+                logging.error(f"Jellyfin partial scan error, falling back to a full refresh: {str(e)}")
+
         try:
             logging.info("Refreshing Jellyfin library...")
             url = f"{self.config.jellyfin_address}/Library/Refresh?api_key={self.config.jellyfin_api_key}"
-            response = requests.post(url)
+            with MEDIA_SERVER_DURATION.labels("jellyfin", "scan").time():
+                response = self.http_session.post(url, timeout=30)
 
             if response.status_code == 204:
                 logging.info("Jellyfin library refreshed successfully.")
             else:
+                MEDIA_SERVER_ERRORS.labels("jellyfin", "scan").inc()
                 logging.error(f"Failed to refresh Jellyfin library: {response.status_code} - {response.text}")
 
         except Exception as e:
+            MEDIA_SERVER_ERRORS.labels("jellyfin", "scan").inc()
             logging.error(f"Jellyfin scan error: {str(e)}")
 
     def import_playlist_to_plex(self):
@@ -82,30 +210,48 @@ class PlaylistManager:
 
             url = f"{self.config.plex_address}/playlists/upload?sectionID={self.config.plex_library_section_id}&path={plex_m3u_file_path}&X-Plex-Token={self.config.plex_token}"
 
-            response = requests.post(url)
+            with MEDIA_SERVER_DURATION.labels("plex", "playlist_import").time():
+                response = self.http_session.post(url, timeout=30)
             if response.status_code == 200:
                 logging.info(f"Plex Playlist Imported Successfully: {plex_m3u_file_path}")
             else:
+                MEDIA_SERVER_ERRORS.labels("plex", "playlist_import").inc()
                 logging.error(f"Plex Playlist Failed to Import: {plex_m3u_file_path}. Status Code: {str(response.status_code)}")
 
         except Exception as e:
+            MEDIA_SERVER_ERRORS.labels("plex", "playlist_import").inc()
             logging.error(f"Plex Playlist Import Error: {str(e)}")
 
-    def media_server_refresh_check(self):
-        # Refresh Library to pick up new files
-        if self.config.trigger_jellyfin_scan.lower() == "true":
-            self.refresh_jellyfin_library()
-        if self.config.trigger_plex_scan.lower() == "true":
-            self.refresh_plex_library()
+    def media_server_refresh_check(self, changed_paths=None):
+        # Called from download workers, the actual refresh runs on the scheduler thread
+        self.refresh_scheduler.trigger(changed_paths)
 
-        # Generate/Update Playlist
+    def run_media_server_refresh(self, changed_paths=None):
+        # Generate/Update Playlist first so a single library refresh picks up both files and playlist
         if self.config.generate_m3u_playlist.lower() == "true":
             logging.info("M3U Playlist Generation started...")
             self.generate_m3u_playlist()
+            if changed_paths:
+                changed_paths = set(changed_paths) | {self.config.m3u_playlist_path}
+
+        scan_paths = self.get_scan_paths(changed_paths)
+
+        # Refresh Library to pick up new files
+        if self.config.trigger_jellyfin_scan.lower() == "true":
+            self.refresh_jellyfin_library(scan_paths)
+        if self.config.trigger_plex_scan.lower() == "true":
+            self.refresh_plex_library(scan_paths)
+
+        if self.config.generate_m3u_playlist.lower() == "true" and self.config.trigger_plex_scan.lower() == "true":
+            self.schedule_plex_playlist_import()
 
-            # Refresh Library to pick up playlist
-            if self.config.trigger_jellyfin_scan.lower() == "true":
-                self.refresh_jellyfin_library()
-            if self.config.trigger_plex_scan.lower() == "true":
-                logging.info(f"Delaying Plex Playlist Import for {self.config.plex_playlist_import_delay} seconds")
-                threading.Timer(self.config.plex_playlist_import_delay, self.import_playlist_to_plex).start()
+    def schedule_plex_playlist_import(self):
+        with self.plex_import_lock:
+            # A pending import reads the playlist when it fires, so it already covers this refresh
+            if self.plex_import_timer and self.plex_import_timer.is_alive():
+                logging.info("Plex Playlist Import already scheduled")
+                return
+            logging.info(f"Delaying Plex Playlist Import for {self.config.plex_playlist_import_delay} seconds")
+            self.plex_import_timer = threading.Timer(self.config.plex_playlist_import_delay, self.import_playlist_to_plex)
+            self.plex_import_timer.daemon = True
+            self.plex_import_timer.start()
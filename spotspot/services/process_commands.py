@@ -0,0 +1,73 @@
+import time
+import uuid
+import logging
+import threading
+from services.database import open_database
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Commands are only needed by processes that were running when they were sent
+COMMAND_MAX_AGE = 3600
+
+
+class CommandChannel:
+    # Passes commands like cancelling downloads or reloading settings between the web workers and the download runner
+    def __init__(self, config, handlers, poll_interval=1):
+        self.config = config
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.origin = uuid.uuid4().hex
+        self.lock = threading.Lock()
+
+        self.connection = open_database(self.config)
+        self.create_schema()
+        # Commands sent before this process started were meant for others
+        self.last_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM process_commands").fetchone()[0]
+
+    def create_schema(self):
+        with self.lock:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS process_commands (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    origin TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    def is_enabled(self):
+        return self.config.download_runner == "separate"
+
+    def send(self, name):
+        if not self.is_enabled():
+            return
+        with self.lock:
+            now = time.time()
+            self.connection.execute("INSERT INTO process_commands (origin, name, created_at) VALUES (?, ?, ?)", (self.origin, name, now))
+            self.connection.execute("DELETE FROM process_commands WHERE created_at < ?", (now - COMMAND_MAX_AGE,))
+
+    def start(self):
+        if not self.is_enabled():
+            return
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error(f"Command Channel Error: {str(e)}")
+
+    def poll(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, origin, name FROM process_commands WHERE id > ? ORDER BY id", (self.last_id,)).fetchall()
+        for command_id, origin, name in rows:
+            self.last_id = command_id
+            # The sender already ran the command itself where it could
+            if origin == self.origin or name not in self.handlers:
+                continue
+            logging.info(f"Running {name} sent by another process")
+            self.handlers[name]()
@@ -0,0 +1,65 @@
+import time
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class RefreshScheduler:
+    def __init__(self, config, refresh_callback):
+        self.config = config
+        self.refresh_callback = refresh_callback
+        self.condition = threading.Condition()
+        self.first_trigger_at = None
+        self.last_trigger_at = None
+        self.trigger_count = 0
+        self.changed_paths = set()
+        self.full_refresh = False
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def trigger(self, changed_paths=None):
+        with self.condition:
+            # A trigger without paths means we do not know what changed, so scan everything
+            if changed_paths:
+                self.changed_paths.update(changed_paths)
+            else:
+                self.full_refresh = True
+            now = time.monotonic()
+            if self.first_trigger_at is None:
+                self.first_trigger_at = now
+            self.last_trigger_at = now
+            self.trigger_count += 1
+            self.condition.notify()
+
+    def seconds_until_due(self):
+        # Wait for a quiet period, but never hold a refresh back longer than the max delay
+        now = time.monotonic()
+        quiet_due = self.last_trigger_at + self.config.media_refresh_debounce
+        max_due = self.first_trigger_at + self.config.media_refresh_max_delay
+        return min(quiet_due, max_due) - now
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.first_trigger_at is None:
+                    self.condition.wait()
+
+                remaining = self.seconds_until_due()
+                if remaining > 0:
+                    self.condition.wait(timeout=remaining)
+                    continue
+
+                merged_triggers = self.trigger_count
+                changed_paths = None if self.full_refresh else self.changed_paths
+                self.first_trigger_at = None
+                self.last_trigger_at = None
+                self.trigger_count = 0
+                self.changed_paths = set()
+                self.full_refresh = False
+
+            logging.info(f"Running media server refresh for {merged_triggers} merged trigger(s)")
+            try:
+                self.refresh_callback(changed_paths)
+            except Exception as e:
+                logging.error(f"Media Server Refresh Error: {str(e)}")
@@ -0,0 +1,49 @@
+import re
+import random
+
+THROTTLE_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
+        r"\b429\b",
+        r"Too Many Requests",
+        # The bot check only, "Sign in to confirm your age" is an age gate that waiting does not fix
+        r"Sign in to confirm you.?re not a bot",
+        r"rate.?limit",
+        r"request limit",
+    )
+]
+RETRY_AFTER_PATTERN = re.compile(r"(?:Retry will occur after|Retry-After)\W+(\d+)", re.IGNORECASE)
+# A job that keeps getting throttled after this many queue pauses is failed rather than pausing the queue again
+THROTTLE_MAX_RETRIES = 5
+# Songs spotdl cannot match or that Spotify no longer serves fail the same way every time
+PERMANENT_PATTERNS = [
+    re.compile(pattern)
+    for pattern in (
+        r"LookupError",
+        r"No results found",
+        r"SongError",
+        r"invalid id",
+        r"non existing id",
+        r"Sign in to confirm your age",
+    )
+]
+
+
+def classify_failure(returncode, stderr):
+    # Returns "throttled", "permanent" or "transient" for a failed spotdl run
+    stderr = stderr or ""
+    if any(pattern.search(stderr) for pattern in THROTTLE_PATTERNS):
+        return "throttled"
+    if any(pattern.search(stderr) for pattern in PERMANENT_PATTERNS):
+        return "permanent"
+    return "transient"
+
+
+def get_retry_after(stderr):
+    retry_after_match = RETRY_AFTER_PATTERN.search(stderr or "")
+    return int(retry_after_match.group(1)) if retry_after_match else None
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    # Full jitter keeps jobs that failed together from all retrying at the same moment
+    return random.uniform(base_delay, min(max_delay, base_delay * 2 ** (attempt - 1)))
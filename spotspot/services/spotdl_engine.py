@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import select
+import logging
+import resource
+import threading
+import subprocess
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class EngineCancelled(Exception):
+    pass
+
+
+def get_rss_mb():
+    try:
+        with open("/proc/self/statm", "r") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def engine_worker_main(config_path, result_fd):
+    # Runs in the engine process: pay spotdl's imports and client setup once, then serve jobs from stdin
+    results = os.fdopen(result_fd, "w", buffering=1)
+
+    def send(message):
+        results.write(json.dumps(message) + "\n")
+
+    try:
+        from spotdl import Spotdl
+        from spotdl.download.downloader import Downloader
+        from spotdl.utils.config import DOWNLOADER_OPTIONS
+
+        with open(config_path, "r", encoding="utf-8") as config_file:
+            settings = json.load(config_file)
+
+        downloader_settings = {key: settings[key] for key in DOWNLOADER_OPTIONS if key in settings}
+        spotdl_client = Spotdl(
+            client_id=settings["client_id"],
+            client_secret=settings["client_secret"],
+            user_auth=settings.get("user_auth", False),
+            cache_path=settings.get("cache_path"),
+            no_cache=settings.get("no_cache", False),
+            headless=settings.get("headless", False),
+            downloader_settings=downloader_settings,
+        )
+        default_downloader = spotdl_client.downloader
+        # Download profiles get their own downloader, built the first time a job asks for one
+        profile_downloaders = {}
+        send({"event": "ready", "rss_mb": get_rss_mb()})
+
+    except Exception as e:
+        send({"event": "error", "error": f"Engine start failed: {str(e)}"})
+        return
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            profile_settings = job.get("settings") or {}
+            if profile_settings:
+                profile_key = json.dumps(profile_settings, sort_keys=True)
+                if profile_key not in profile_downloaders:
+                    # rich allows one live display per process, so profile downloaders share the default one
+                    profile_downloader = Downloader({**default_downloader.settings, **profile_settings, "simple_tui": True})
+                    profile_downloader.progress_handler = default_downloader.progress_handler
+                    profile_downloaders[profile_key] = profile_downloader
+                spotdl_client.downloader = profile_downloaders[profile_key]
+            else:
+                spotdl_client.downloader = default_downloader
+            spotdl_client.downloader.settings["output"] = job["output"]
+            skip_urls = set(job.get("skip_urls") or [])
+            songs = [song for song in spotdl_client.search(job["urls"]) if song.url not in skip_urls]
+            download_results = spotdl_client.download_songs(songs) if songs else []
+            songs_info = [{"url": song.url, "song_id": song.song_id, "isrc": song.isrc, "path": str(path) if path else None} for song, path in download_results]
+            returncode = 0 if (songs_info or skip_urls) and all(song["path"] for song in songs_info) else 1
+            send({"event": "result", "returncode": returncode, "songs": songs_info, "error": "", "rss_mb": get_rss_mb()})
+
+        except Exception as e:
+            send({"event": "result", "returncode": 1, "songs": [], "error": str(e), "rss_mb": get_rss_mb()})
+
+
+class EngineJob:
+    # Stands in for the process in the active downloads, so a late cancel only reaches the job it was meant for
+    def __init__(self, engine_worker, job_token):
+        self.engine_worker = engine_worker
+        self.job_token = job_token
+
+    def terminate(self):
+        self.engine_worker.terminate(self.job_token)
+
+
+class SpotdlEngineWorker:
+    def __init__(self, config, worker_id):
+        self.config = config
+        self.worker_id = worker_id
+        self.process = None
+        self.results = None
+        self.jobs_done = 0
+        self.rss_mb = 0
+        self.cancelled = False
+        self.job_token = 0
+        self.cancel_lock = threading.Lock()
+        self.settings_version = None
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        start_time = time.perf_counter()
+        read_fd, write_fd = os.pipe()
+        # Results come back on a dedicated pipe so spotdl's own console output can go to the logs
+        command = [sys.executable, os.path.abspath(__file__), self.config.config_path, str(write_fd)]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, pass_fds=(write_fd,), text=True)
+        os.close(write_fd)
+        self.results = os.fdopen(read_fd, "r")
+        self.jobs_done = 0
+        self.settings_version = self.config.settings_version
+
+        message = self.receive()
+        if message["event"] != "ready":
+            self.stop()
+            raise RuntimeError(message.get("error", "Engine failed to start"))
+        self.rss_mb = message["rss_mb"]
+        logging.info(f"SpotDL engine {self.worker_id} ready in {time.perf_counter() - start_time:.2f}s (pid {self.process.pid})")
+
+    def receive(self):
+        # Wait with a timeout so a cancelled or crashed engine is noticed
+        while True:
+            readable, _, _ = select.select([self.results], [], [], 0.5)
+            if readable:
+                line = self.results.readline()
+                if line:
+                    return json.loads(line)
+            if self.process.poll() is not None:
+                if self.cancelled:
+                    raise EngineCancelled()
+                raise RuntimeError(f"Engine process exited with code {self.process.returncode}")
+
+    def begin_job(self):
+        # Cancels meant for an earlier job are dropped once the next one is registered
+        with self.cancel_lock:
+            self.job_token += 1
+            self.cancelled = False
+            return EngineJob(self, self.job_token)
+
+    def run_job(self, urls, output, skip_urls=None, on_sent=None, settings=None):
+        # A cancel that arrived before the job was sent still counts
+        if self.cancelled:
+            self.cancelled = False
+            raise EngineCancelled()
+
+        # The engine read config.json when it started, a reload needs a fresh one
+        if self.is_running() and self.settings_version != self.config.settings_version:
+            logging.info(f"Restarting SpotDL engine {self.worker_id} to apply new settings")
+            self.stop()
+
+        try:
+            if not self.is_running():
+                self.start()
+            self.process.stdin.write(json.dumps({"urls": urls, "output": output, "skip_urls": skip_urls or [], "settings": settings or {}}) + "\n")
+            self.process.stdin.flush()
+            if on_sent:
+                on_sent()
+            result = self.receive()
+        except (EngineCancelled, OSError):
+            was_cancelled = self.cancelled
+            self.cancelled = False
+            self.stop()
+            if was_cancelled:
+                raise EngineCancelled()
+            raise
+
+        self.cancelled = False
+        self.jobs_done += 1
+        self.rss_mb = result.get("rss_mb", 0)
+        if self.should_recycle():
+            logging.info(f"Recycling SpotDL engine {self.worker_id} after {self.jobs_done} jobs at {self.rss_mb:.0f} MB")
+            self.stop()
+        return result
+
+    def should_recycle(self):
+        if self.config.engine_max_jobs > 0 and self.jobs_done >= self.config.engine_max_jobs:
+            return True
+        return self.config.engine_max_memory_mb > 0 and self.rss_mb >= self.config.engine_max_memory_mb
+
+    def terminate(self, job_token):
+        # Job-level cancellation: the engine is killed and started again for the next job
+        with self.cancel_lock:
+            if job_token != self.job_token:
+                return
+            self.cancelled = True
+            if self.is_running():
+                self.process.terminate()
+
+    def stop(self):
+        try:
+            if self.is_running():
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+        except Exception as e:
+            logging.error(f"SpotDL Engine Stop Error: {str(e)}")
+            self.process.kill()
+        finally:
+            if self.results is not None:
+                self.results.close()
+            self.process = None
+            self.results = None
+
+
+if __name__ == "__main__":
+    engine_worker_main(sys.argv[1], int(sys.argv[2]))
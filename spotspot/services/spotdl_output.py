@@ -0,0 +1,88 @@
+import os
+import re
+import codecs
+import selectors
+from collections import deque
+
+FOUND_SONGS_PATTERN = re.compile(r"Found (\d+) songs in (.+) \(")
+DOWNLOADED_PATTERN = re.compile(r'Downloaded "(.+)": ')
+SKIPPED_PATTERN = re.compile(r"Skipping (.+?) \((?:file already exists|skip file found)")
+SONG_ERROR_PATTERN = re.compile(r"^(\w+Error): (.*)")
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class SpotdlProgress:
+    def __init__(self, total=0):
+        # Single tracks are known up front, albums and playlists report their size once spotdl has fetched them
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.current = None
+
+    def feed(self, line):
+        found_match = FOUND_SONGS_PATTERN.search(line)
+        if found_match:
+            self.total += int(found_match.group(1))
+            return True
+
+        song_match = DOWNLOADED_PATTERN.search(line) or SKIPPED_PATTERN.search(line)
+        if song_match:
+            self.completed += 1
+            self.current = song_match.group(1)
+            return True
+
+        # Tracebacks can repeat the error line, a job never has more failures than songs left
+        error_match = SONG_ERROR_PATTERN.search(line.strip())
+        if error_match and (not self.total or self.completed + self.failed < self.total):
+            self.failed += 1
+            self.current = error_match.group(2).rsplit("song: ", 1)[-1]
+            return True
+
+        return False
+
+    def to_dict(self):
+        return {"completed": self.completed, "failed": self.failed, "total": max(self.total, self.completed + self.failed), "current": self.current}
+
+
+def stream_process_output(process, handle_line, error_tail_lines=50):
+    # Reads stdout and stderr as they fill so neither pipe can block spotdl, keeping only a short stderr tail
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    for stream_name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+        selector.register(stream, selectors.EVENT_READ, stream_name)
+        buffers[stream_name] = [codecs.getincrementaldecoder("utf-8")(errors="replace"), ""]
+    error_tail = deque(maxlen=error_tail_lines)
+
+    def emit_line(stream_name, line):
+        if stream_name == "stderr":
+            error_tail.append(line)
+        handle_line(stream_name, line)
+
+    try:
+        while selector.get_map():
+            for key, _ in selector.select():
+                stream_name = key.data
+                decoder, pending = buffers[stream_name]
+                chunk = os.read(key.fileobj.fileno(), 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    pending += decoder.decode(b"", final=True)
+                    if pending:
+                        emit_line(stream_name, pending)
+                    buffers[stream_name][1] = ""
+                    continue
+
+                pending += decoder.decode(chunk)
+                *lines, pending = re.split(r"\r?\n|\r", pending)
+                if len(pending) > MAX_LINE_LENGTH:
+                    lines.append(pending)
+                    pending = ""
+                for line in lines:
+                    if line:
+                        emit_line(stream_name, line)
+                buffers[stream_name][1] = pending
+    finally:
+        selector.close()
+
+    process.wait()
+    return "\n".join(error_tail)
@@ -1,34 +1,152 @@
+import time
 import logging
+import requests
+import threading
 import spotipy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from spotipy.cache_handler import MemoryCacheHandler
 from spotipy.oauth2 import SpotifyClientCredentials
+from services.search_cache import SearchCache
+from services.metrics import SEARCH_DURATION, SEARCH_ERRORS
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+SEARCH_CATEGORIES = ("track", "album", "artist", "playlist")
+
+
+class SharedClientCredentials(SpotifyClientCredentials):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_lock = threading.Lock()
+
+    def get_access_token(self, as_dict=False, check_cache=True):
+        # Serialise token refreshes so concurrent searches reuse a single fetch
+        with self.token_lock:
+            return super().get_access_token(as_dict=as_dict, check_cache=check_cache)
+
 
 class SpotifyService:
-    def __init__(self, config):
+    def __init__(self, config, thumbnail_cache=None):
         self.config = config
+        self.thumbnail_cache = thumbnail_cache
+        self.search_cache = SearchCache(self.config.search_cache_size, self.config.search_cache_ttl)
+        self.sp = None
+        self.client_lock = threading.Lock()
+
+    def get_spotify_client(self):
+        with self.client_lock:
+            if self.sp is None:
+                session = requests.Session()
+                retry = Retry(total=3, connect=None, read=False, allowed_methods=frozenset(["GET", "POST"]), status=3, backoff_factor=0.3)
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.config.spotify_pool_size, max_retries=retry)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+
+                auth_manager = SharedClientCredentials(
+                    client_id=self.config.client_id,
+                    client_secret=self.config.client_secret,
+                    requests_session=session,
+                    requests_timeout=10,
+                    cache_handler=MemoryCacheHandler(),
+                )
+                self.sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=session, requests_timeout=10)
+                logging.info(f"Spotify client created with a connection pool of {self.config.spotify_pool_size}")
+            return self.sp
 
     def perform_spotify_search(self, search_req):
+        search_start = time.perf_counter()
+        query_type = search_req.get("type", "track")
+        # Search types come from the client, unknown ones share a label
+        metric_type = query_type if query_type in ("track", "album", "artist", "playlist", "all") else "other"
         try:
             parsed_results = None
-            query_type = search_req.get("type", "track")
             query = search_req.get("query")
             search_type = "album,artist,playlist,track" if query_type == "all" else query_type
 
             logging.info(f"Search query: {query}, Type: {search_type}")
-            client_credentials_manager = SpotifyClientCredentials(client_id=self.config.client_id, client_secret=self.config.client_secret)
-            self.sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+            cache_key = self.search_cache.make_key(query, search_type, self.config.search_limit)
+            parsed_results = self.search_cache.get(cache_key)
+            if parsed_results is not None:
+                logging.info(f"Search cache hit: {self.search_cache.get_stats()}")
+                SEARCH_DURATION.labels(metric_type, "hit").observe(time.perf_counter() - search_start)
+                return parsed_results
 
-            results = self.sp.search(q=query, limit=self.config.search_limit, type=search_type)
+            results = self.get_spotify_client().search(q=query, limit=self.config.search_limit, type=search_type)
             parsed_results = self.parse_spotify_data(results)
+            self.search_cache.put(cache_key, parsed_results)
+            logging.info(f"Search cache miss: {self.search_cache.get_stats()}")
+            SEARCH_DURATION.labels(metric_type, "miss").observe(time.perf_counter() - search_start)
 
         except Exception as e:
+            SEARCH_ERRORS.labels(metric_type).inc()
             logging.error(f"Spotify Search Error: {str(e)}")
 
         finally:
             return parsed_results
 
+    def stream_spotify_search(self, search_req, on_category):
+        # One request per category, each handed to on_category as soon as it is parsed, tracks are requested first
+        query = search_req.get("query")
+        with ThreadPoolExecutor(max_workers=len(SEARCH_CATEGORIES)) as executor:
+            futures = {executor.submit(self.perform_spotify_search, {"query": query, "type": category}): category for category in SEARCH_CATEGORIES}
+            for remaining, future in enumerate(as_completed(futures), start=1):
+                category = f"{futures[future]}s"
+                parsed_results = future.result() or {}
+                on_category(category, parsed_results.get(category, []), len(futures) - remaining)
+
+    def fetch_all_pages(self, fetch_page, page_size):
+        # The first page gives the total, the remaining pages are fetched concurrently
+        first_page = fetch_page(0)
+        offsets = range(page_size, first_page["total"] or 0, page_size)
+        items = list(first_page["items"])
+        if offsets:
+            with ThreadPoolExecutor(max_workers=self.config.spotify_fetch_workers) as executor:
+                for page in executor.map(fetch_page, offsets):
+                    items += page["items"]
+        return items
+
+    def parse_collection_track(self, track):
+        if not track or not track.get("id"):
+            return None
+        return {
+            "id": track["id"],
+            "isrc": (track.get("external_ids") or {}).get("isrc"),
+            "name": track.get("name"),
+            "artist": track["artists"][0]["name"] if track.get("artists") else None,
+            "url": (track.get("external_urls") or {}).get("spotify") or f"https://open.spotify.com/track/{track['id']}",
+        }
+
+    def get_album_tracks(self, album_url):
+        sp = self.get_spotify_client()
+        tracks = self.fetch_all_pages(lambda offset: sp.album_tracks(album_url, limit=50, offset=offset), 50)
+        return [self.parse_collection_track(track) for track in tracks]
+
+    def get_collection_items(self, item_type, url):
+        # Returns every track of an album, playlist or artist, album listings carry no ISRC
+        sp = self.get_spotify_client()
+        if item_type == "album":
+            tracks = self.get_album_tracks(url)
+        elif item_type == "playlist":
+            fields = "items(track(id,name,artists(name),external_urls,external_ids(isrc))),total"
+            items = self.fetch_all_pages(lambda offset: sp.playlist_items(url, fields=fields, limit=100, offset=offset, additional_types=("track",)), 100)
+            tracks = [self.parse_collection_track(item.get("track")) for item in items if item]
+        elif item_type == "artist":
+            albums = self.fetch_all_pages(lambda offset: sp.artist_albums(url, include_groups="album,single", limit=50, offset=offset), 50)
+            with ThreadPoolExecutor(max_workers=self.config.spotify_fetch_workers) as executor:
+                tracks = [track for album_tracks in executor.map(self.get_album_tracks, [album["id"] for album in albums]) for track in album_tracks]
+        else:
+            return None
+
+        # Playlists can hold the same track twice and artists share tracks between releases
+        unique_tracks = {}
+        for track in tracks:
+            if track and track["id"] not in unique_tracks:
+                unique_tracks[track["id"]] = track
+        logging.info(f"Fetched {len(unique_tracks)} tracks for {item_type} {url}")
+        return list(unique_tracks.values())
+
     def parse_spotify_data(self, results):
         parsed_results = {"tracks": [], "albums": [], "artists": [], "playlists": []}
 
@@ -38,11 +156,13 @@ class SpotifyService:
                 parsed_results["tracks"].append(
                     {
                         "type": "track",
+                        "id": item["id"],
+                        "isrc": item.get("external_ids", {}).get("isrc"),
                         "name": item["name"],
                         "artist": item["artists"][0]["name"],
                         "album": item["album"]["name"],
                         "url": item["external_urls"]["spotify"],
-                        "image": item["album"]["images"][0]["url"] if item["album"]["images"] else None,
+                        **self.get_image(item["album"]["images"]),
                     }
                 )
 
@@ -56,7 +176,7 @@ class SpotifyService:
                         "artist": item["artists"][0]["name"],
                         "release_date": item["release_date"],
                         "url": item["external_urls"]["spotify"],
-                        "image": item["images"][0]["url"] if item["images"] else None,
+                        **self.get_image(item["images"]),
                     }
                 )
 
@@ -69,7 +189,7 @@ class SpotifyService:
                         "name": item["name"],
                         "followers": item["followers"]["total"],
                         "url": item["external_urls"]["spotify"],
-                        "image": item["images"][0]["url"] if item["images"] else None,
+                        **self.get_image(item["images"]),
                     }
                 )
 
@@ -84,8 +204,16 @@ class SpotifyService:
                         "name": item["name"],
                         "owner": item["owner"]["display_name"],
                         "url": item["external_urls"]["spotify"],
-                        "image": item["images"][0]["url"] if item["images"] else None,
+                        **self.get_image(item["images"]),
                     }
                 )
 
         return {key: value for key, value in parsed_results.items() if value}
+
+    def get_image(self, images):
+        if not images:
+            return {"image": None}
+        # With the proxy on, results carry a cache key and the browser loads the thumbnail from SpotSpot
+        if self.thumbnail_cache and self.thumbnail_cache.is_enabled():
+            return {"thumbnail": self.thumbnail_cache.register(images)}
+        return {"image": images[0]["url"]}
@@ -0,0 +1,14 @@
+import re
+
+SPOTIFY_URL_PATTERN = re.compile(r"open\.spotify\.com/(?:intl-[a-z]+/)?(track|album|playlist|artist)/([A-Za-z0-9]+)")
+
+
+def get_track_id(url):
+    match = SPOTIFY_URL_PATTERN.search(url or "")
+    return match.group(2) if match and match.group(1) == "track" else None
+
+
+def get_url_key(url):
+    # Share links differ by locale prefix and tracking parameters but point at the same item
+    match = SPOTIFY_URL_PATTERN.search(url or "")
+    return f"{match.group(1)}/{match.group(2)}" if match else (url or "").strip()
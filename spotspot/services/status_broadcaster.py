@@ -0,0 +1,82 @@
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Only what the status page shows is sent, jobs also carry internals like the browser's session ID
+STATUS_FIELDS = ("id", "name", "type", "artist", "url", "status", "parent_id")
+
+
+def get_status_fields(item):
+    return {field: item.get(field) for field in STATUS_FIELDS}
+
+
+class StatusBroadcaster:
+    def __init__(self, socketio, coalesce_window, progress_interval, version_store):
+        self.socketio = socketio
+        self.coalesce_window = coalesce_window
+        self.progress_interval = progress_interval
+        # Web workers and the download runner all publish patches, the version counter lives in the shared database
+        self.version_store = version_store
+        self.pending_items = {}
+        self.flush_scheduled = False
+        self.pending_progress = {}
+        self.progress_flush_scheduled = False
+        self.lock = threading.Lock()
+
+    def item_changed(self, item):
+        with self.lock:
+            # Later changes to the same item within the window replace earlier ones
+            self.pending_items[item["id"]] = get_status_fields(item)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.socketio.start_background_task(self.delayed_flush)
+
+    def delayed_flush(self):
+        self.socketio.sleep(self.coalesce_window)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            if not self.pending_items:
+                return
+            items = list(self.pending_items.values())
+            self.pending_items.clear()
+            version = self.version_store.next_status_version()
+            patch = {"base_version": version - 1, "version": version, "items": items}
+
+        try:
+            self.socketio.emit("status_patch", patch)
+        except Exception as e:
+            logging.error(f"Status Patch Error: {str(e)}")
+
+    def progress_changed(self, item_ids, progress):
+        with self.lock:
+            # Progress is informational, only the latest state per job is sent once per interval
+            self.pending_progress[item_ids[0]] = dict(progress, ids=list(item_ids))
+            if self.progress_flush_scheduled:
+                return
+            self.progress_flush_scheduled = True
+        self.socketio.start_background_task(self.delayed_progress_flush)
+
+    def delayed_progress_flush(self):
+        self.socketio.sleep(self.progress_interval)
+        with self.lock:
+            self.progress_flush_scheduled = False
+            items = list(self.pending_progress.values())
+            self.pending_progress.clear()
+
+        if not items:
+            return
+        try:
+            self.socketio.emit("progress", {"items": items})
+        except Exception as e:
+            logging.error(f"Progress Emit Error: {str(e)}")
+
+    def get_version(self):
+        return self.version_store.get_status_version()
+
+    def snapshot(self, history, version):
+        return {"version": version, "history": [get_status_fields(item) for item in history]}
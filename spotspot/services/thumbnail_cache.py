@@ -0,0 +1,160 @@
+import io
+import os
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import requests
+from PIL import Image
+from services.database import open_database
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Source images remembered for keys handed out in search results
+MAX_SOURCES = 20000
+KEY_PATTERN = re.compile(r"^[0-9a-f]{24}$")
+
+
+class ThumbnailCache:
+    def __init__(self, config):
+        self.config = config
+        self.size = self.config.thumbnail_size
+        self.max_bytes = int(self.config.thumbnail_cache_mb * 1024 * 1024)
+        self.cache_dir = self.config.thumbnail_cache_path
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+        self.sources = OrderedDict()
+        self.session = requests.Session()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+
+        # A thumbnail request can land on another web worker than the search that handed out its key
+        self.shared_sources = None
+        if self.config.web_workers > 1:
+            self.shared_sources = open_database(self.config)
+            self.shared_sources.execute("CREATE TABLE IF NOT EXISTS thumbnail_sources (key TEXT PRIMARY KEY, url TEXT NOT NULL)")
+        logging.info(f"Thumbnail cache holds {self.total_bytes / 1024 / 1024:.1f} MB")
+
+    def is_enabled(self):
+        return self.config.thumbnail_proxy.lower() == "true"
+
+    def choose_source(self, images):
+        # Spotify lists several sizes, the smallest one at least as wide as the thumbnail is enough
+        sized = sorted(images, key=lambda image: image.get("width") or 0)
+        for image in sized:
+            if (image.get("width") or 0) >= self.size:
+                return image["url"]
+        return sized[-1]["url"]
+
+    def register(self, images):
+        source_url = self.choose_source(images)
+        key = hashlib.sha1(f"{source_url}@{self.size}".encode()).hexdigest()[:24]
+        with self.lock:
+            known = key in self.sources
+            self.sources[key] = source_url
+            self.sources.move_to_end(key)
+            while len(self.sources) > MAX_SOURCES:
+                self.sources.popitem(last=False)
+            if self.shared_sources and not known:
+                # Replacing gives the row a new rowid, so the oldest rowids are the least recently used
+                self.shared_sources.execute("INSERT OR REPLACE INTO thumbnail_sources (key, url) VALUES (?, ?)", (key, source_url))
+                self.shared_sources.execute("DELETE FROM thumbnail_sources WHERE rowid <= (SELECT MAX(rowid) FROM thumbnail_sources) - ?", (MAX_SOURCES,))
+        return key
+
+    def get_source(self, key):
+        with self.lock:
+            source_url = self.sources.get(key)
+            if source_url is None and self.shared_sources:
+                row = self.shared_sources.execute("SELECT url FROM thumbnail_sources WHERE key = ?", (key,)).fetchone()
+                source_url = row[0] if row else None
+            return source_url
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def get_thumbnail(self, key):
+        if not KEY_PATTERN.match(key):
+            return None
+        path = self.get_path(key)
+        thumbnail = self.read_cached(path)
+        if thumbnail is not None:
+            self.hits += 1
+            return thumbnail
+
+        source_url = self.get_source(key)
+        if source_url is None:
+            return None
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(key, threading.Lock())
+
+        # Concurrent requests for the same thumbnail wait for one download
+        with fetch_lock:
+            try:
+                thumbnail = self.read_cached(path)
+                if thumbnail is not None:
+                    return thumbnail
+                self.misses += 1
+                response = self.session.get(source_url, timeout=10)
+                response.raise_for_status()
+                thumbnail = self.resize(response.content)
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(temp_path, "wb") as thumbnail_file:
+                    thumbnail_file.write(thumbnail)
+                os.replace(temp_path, path)
+            except Exception as e:
+                logging.error(f"Thumbnail Error for {source_url}: {e}")
+                return None
+            finally:
+                with self.lock:
+                    self.fetch_locks.pop(key, None)
+
+        with self.lock:
+            self.total_bytes += len(thumbnail)
+        self.evict()
+        return thumbnail
+
+    def read_cached(self, path):
+        # Bytes are returned rather than the path so eviction can remove the file while it is being served
+        try:
+            with open(path, "rb") as thumbnail_file:
+                thumbnail = thumbnail_file.read()
+            # The modified time is the last use, eviction removes the oldest first
+            os.utime(path)
+            return thumbnail
+        except FileNotFoundError:
+            return None
+
+    def resize(self, image_bytes):
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image = image.convert("RGB")
+            if image.width > self.size or image.height > self.size:
+                image.thumbnail((self.size, self.size), Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=85, optimize=True)
+            return output.getvalue()
+
+    def evict(self):
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.is_file()), key=lambda entry: entry.stat().st_mtime)
+            # Trim to 90% so a full cache does not rescan on every new thumbnail
+            target_bytes = self.max_bytes * 0.9
+            for entry in entries:
+                if self.total_bytes <= target_bytes:
+                    break
+                try:
+                    entry_size = entry.stat().st_size
+                    os.remove(entry.path)
+                    self.total_bytes -= entry_size
+                except OSError as e:
+                    logging.error(f"Thumbnail Eviction Error: {e}")
+            logging.info(f"Thumbnail cache trimmed to {self.total_bytes / 1024 / 1024:.1f} MB")
+
+    def get_stats(self):
+        with self.lock:
+            return {"enabled": self.is_enabled(), "size_px": self.size, "bytes": self.total_bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses, "sources": len(self.sources)}
@@ -1,12 +1,19 @@
-import queue
+import io
 import logging
 import threading
-from flask_socketio import SocketIO
-from flask import Flask, render_template
+from flask_socketio import SocketIO, emit
+from flask import Flask, Response, request, render_template, jsonify, send_file, abort
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
 from services.config_service import ConfigService
 from services.spotfiy_service import SpotifyService
 from services.download_service import DownloadService
 from services.playlist_manager import PlaylistManager
+from services.history_store import HistoryStore
+from services.download_queue import PersistentQueue
+from services.library_index import LibraryIndex
+from services.metrics import MeteredPacket, QueueCollector
+from services.thumbnail_cache import ThumbnailCache
+from services.process_commands import CommandChannel
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
@@ -16,60 +23,193 @@ class SpotSpotWebApp:
         # Setup Flask App
         self.app = Flask(__name__)
         self.app.secret_key = "SECRET_KEY"
-        self.socketio = SocketIO(self.app)
+        self.config = ConfigService()
+        # With a message queue, events emitted by any web worker or the download runner reach every browser
+        self.socketio = SocketIO(self.app, serializer=MeteredPacket, message_queue=self.config.socketio_message_queue or None)
         # Setup Data
-        self.download_queue = queue.Queue()
-        self.download_history = {}
         self.active_downloads = {}
+        # Latest search request ID per Socket.IO session, older replies are dropped
+        self.latest_searches = {}
+        self.search_lock = threading.Lock()
         # Instantiate
-        self.config = ConfigService()
-        self.spotify_services = SpotifyService(self.config)
+        self.runs_downloads = self.config.download_runner != "separate"
+        self.history_store = HistoryStore(self.config, recover=self.runs_downloads)
+        self.download_queue = PersistentQueue(self.config, recover=self.runs_downloads)
+        self.library_index = LibraryIndex(self.config)
+        self.thumbnail_cache = ThumbnailCache(self.config)
+        self.spotify_services = SpotifyService(self.config, self.thumbnail_cache)
         self.playlist_manager = PlaylistManager(self.config)
-        self.download_services = DownloadService(self.config, self.playlist_manager, self.socketio, self.download_queue, self.download_history)
+        self.download_services = DownloadService(
+            self.config, self.playlist_manager, self.socketio, self.download_queue, self.history_store, self.spotify_services, self.library_index, run_downloads=self.runs_downloads
+        )
+        self.commands = CommandChannel(self.config, {"reload_settings": self.config.load_saved_settings})
+        REGISTRY.register(QueueCollector(self.download_services))
         # Setup Routes
         self.setup_routes()
-        self.start_download_thread()
+        self.commands.start()
+        if self.runs_downloads:
+            self.start_download_thread()
 
     def setup_routes(self):
         @self.app.route("/")
         def index_page():
-            return render_template("index.html")
+            return render_template("index.html", websocket_only=self.config.web_workers > 1)
 
         @self.app.route("/status")
         def status_page():
-            return render_template("status.html")
+            return render_template("status.html", websocket_only=self.config.web_workers > 1)
+
+        @self.app.route("/search_cache")
+        def search_cache_stats():
+            return jsonify(self.spotify_services.search_cache.get_stats())
+
+        @self.app.route("/thumbnail/<key>")
+        def thumbnail(key):
+            thumbnail = self.thumbnail_cache.get_thumbnail(key)
+            if thumbnail is None:
+                abort(404)
+            # A key always maps to the same image, so browsers can keep it for good
+            response = send_file(io.BytesIO(thumbnail), mimetype="image/jpeg", etag=key, max_age=31536000, conditional=True)
+            response.cache_control.immutable = True
+            return response
+
+        @self.app.route("/thumbnail_cache")
+        def thumbnail_cache_stats():
+            return jsonify(self.thumbnail_cache.get_stats())
+
+        @self.app.route("/admin/config", methods=["GET", "POST"])
+        def admin_config():
+            if not self.config.is_admin(request.headers.get("X-Admin-Token")):
+                abort(403)
+            if request.method == "POST":
+                changes = request.get_json(force=True, silent=True)
+                if not isinstance(changes, dict):
+                    return jsonify({"error": "body must be a JSON object"}), 400
+                try:
+                    self.config.update_settings(changes.get("settings"), changes.get("profiles"))
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 400
+                self.commands.send("reload_settings")
+                self.socketio.emit("profiles", self.config.get_profile_names())
+            return jsonify(self.config.get_runtime_config())
+
+        @self.app.route("/metrics")
+        def metrics():
+            return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
 
         @self.socketio.on("search")
         def handle_search(query_req):
+            request_id = query_req.get("request_id")
+            with self.search_lock:
+                self.latest_searches[request.sid] = request_id
             if not query_req.get("query"):
-                self.socketio.emit("toast", {"title": "Blank Search Query", "body": "Please enter search request"})
-                parsed_results = {}
-            else:
-                parsed_results = self.spotify_services.perform_spotify_search(query_req)
-            self.socketio.emit("search_results", {"results": parsed_results})
+                emit("toast", {"title": "Blank Search Query", "body": "Please enter search request"})
+                emit("search_results", {"request_id": request_id, "results": {}})
+                return
+            # Searches run outside the handler so a newer query from the same browser is not stuck behind an older one
+            self.socketio.start_background_task(self.run_search, request.sid, request_id, query_req)
+
+        @self.socketio.on("disconnect")
+        def handle_disconnect():
+            with self.search_lock:
+                self.latest_searches.pop(request.sid, None)
 
         @self.socketio.on("download_item")
         def handle_download(requested_item):
-            self.download_services.add_item_to_queue(requested_item)
+            queue_notice = self.download_services.add_item_to_queue(requested_item, request.sid)
+            if queue_notice:
+                emit("toast", queue_notice)
 
         @self.socketio.on("get_status")
-        def handle_get_status():
-            self.socketio.emit("update_status", {"history": list(self.download_history.values())})
+        def handle_get_status(status_req=None):
+            status_req = status_req or {}
+            snapshot = self.download_services.get_status_snapshot(status_req.get("page", 1), status_req.get("page_size", 50), status_req.get("status"))
+            emit("update_status", snapshot)
+
+        @self.socketio.on("get_queue_positions")
+        def handle_get_queue_positions(data=None):
+            history_ids = data.get("ids") if isinstance(data, dict) else None
+            if not isinstance(history_ids, list):
+                return
+            positions = self.download_services.get_queue_positions([history_id for history_id in history_ids[:100] if isinstance(history_id, int)])
+            emit("queue_positions", {"positions": [[history_id, position] for history_id, position in positions.items()]})
 
         @self.socketio.on("cancel_all")
         def cancel_all():
             logging.info(f"Request to cancel all download recieved")
-            self.download_services.cancel_active_download()
             self.download_services.cancel_pending_downloads()
+            self.cancel_active_downloads()
 
         @self.socketio.on("cancel_active")
         def cancel_active():
-            logging.info(f"Request to cancel active download recieved")
-            self.download_services.cancel_active_download()
+            logging.info(f"Request to cancel active downloads recieved")
+            self.cancel_active_downloads()
+
+        @self.socketio.on("get_profiles")
+        def get_profiles():
+            emit("profiles", self.config.get_profile_names())
+
+        @self.socketio.on("update_config")
+        def update_config(data=None):
+            if not isinstance(data, dict) or not self.config.is_admin(data.get("token")):
+                emit("toast", {"title": "Settings Not Changed", "body": "Admin token missing or wrong"})
+                return
+            try:
+                self.config.update_settings(data.get("settings"), data.get("profiles"))
+            except ValueError as e:
+                emit("toast", {"title": "Settings Not Changed", "body": str(e)})
+                return
+            self.commands.send("reload_settings")
+            emit("config_updated", self.config.get_runtime_config())
+            self.socketio.emit("profiles", self.config.get_profile_names())
+
+        @self.socketio.on("retry_item")
+        def retry_item(data):
+            logging.info(f"Request to retry download {data.get('id')} recieved")
+            self.download_services.retry_item(data.get("id"), data.get("client_id") or request.sid)
+
+        @self.socketio.on("move_item")
+        def move_item(data):
+            position = self.download_services.move_item(data.get("id"), data.get("direction"))
+            if position:
+                # Every status page reloads its positions, a move shifts the other items too
+                self.socketio.emit("queue_changed")
+
+    def cancel_active_downloads(self):
+        # Downloads may be running in the separate runner, which picks the command up from the shared database
+        self.download_services.cancel_active_download()
+        self.commands.send("cancel_active")
+
+    def is_latest_search(self, sid, request_id):
+        with self.search_lock:
+            return sid in self.latest_searches and self.latest_searches[sid] == request_id
+
+    def run_search(self, sid, request_id, query_req):
+        if not self.is_latest_search(sid, request_id):
+            return
+        if query_req.get("type") == "all" and self.config.stream_all_search.lower() == "true":
+            self.stream_search(sid, request_id, query_req)
+            return
+        parsed_results = self.library_index.mark_downloaded(self.spotify_services.perform_spotify_search(query_req))
+        if not self.is_latest_search(sid, request_id):
+            logging.info(f"Search for {query_req.get('query')} superseded by a newer one, results dropped")
+            return
+        self.socketio.emit("search_results", {"request_id": request_id, "results": parsed_results}, to=sid)
+
+    def stream_search(self, sid, request_id, query_req):
+        def send_category(category, items, remaining):
+            if not self.is_latest_search(sid, request_id):
+                return
+            if category == "tracks":
+                items = self.library_index.mark_downloaded({"tracks": items})["tracks"]
+            self.socketio.emit("search_category", {"request_id": request_id, "category": category, "items": items, "remaining": remaining}, to=sid)
+
+        self.spotify_services.stream_spotify_search(query_req, send_category)
 
     def start_download_thread(self):
-        download_thread = threading.Thread(target=self.download_services.process_downloads, daemon=True)
-        download_thread.start()
+        for worker_id in range(self.config.download_workers):
+            download_thread = threading.Thread(target=self.download_services.process_downloads, args=(worker_id,), daemon=True)
+            download_thread.start()
 
     def run_app(self):
         self.socketio.run(self.app, host="0.0.0.0", port=5000)
@@ -1,22 +1,29 @@
-const socket = io();
+// Several web workers cannot share a long-polling session, a websocket stays on the worker it connected to
+const socket = io(document.body.dataset.websocketOnly === "true" ? { transports: ["websocket"] } : {});
 const searchButton = document.getElementById('search-button');
 const spinnerBorder = document.getElementById('spinner-border');
 const searchInput = document.getElementById('search-input');
 const searchDropdown = document.getElementById('search-dropdown');
+const profileGroup = document.getElementById('profile-group');
+const profileSelect = document.getElementById('profile-select');
 let selectedType = "track";
+let searchRequestId = 0;
+const categoryOrder = ["tracks", "albums", "artists", "playlists"];
+const clientId = getClientId();
+
+function getClientId() {
+    // Kept across reloads so the queue shares downloads fairly between browsers, not tabs
+    let id = localStorage.getItem('clientId');
+    if (!id) {
+        id = Math.random().toString(36).slice(2) + Date.now().toString(36);
+        localStorage.setItem('clientId', id);
+    }
+    return id;
+}
 
 function changeUI(reqState) {
-    if (reqState === "busy") {
-        searchInput.disabled = true;
-        searchButton.disabled = true;
-        searchDropdown.disabled = true;
-        spinnerBorder.style.display = 'inline-block';
-    } else {
-        spinnerBorder.style.display = 'none';
-        searchInput.disabled = false;
-        searchButton.disabled = false;
-        searchDropdown.disabled = false;
-    }
+    // The search box stays usable, a new search replaces the one still running
+    spinnerBorder.style.display = reqState === "busy" ? 'inline-block' : 'none';
 }
 
 function updateSelection(option) {
@@ -27,10 +34,24 @@ function updateSelection(option) {
 function initiateSearch() {
     changeUI("busy");
     const searchText = searchInput.value;
-    socket.emit('search', { query: searchText, type: selectedType });
+    searchRequestId += 1;
+    socket.emit('search', { query: searchText, type: selectedType, request_id: searchRequestId });
 }
 
-function populateTemplate(type, data) {
+function setImage(img, data) {
+    // Thumbnails come from SpotSpot's cache, the logo stands in when there is none
+    img.onerror = () => {
+        img.onerror = null;
+        img.src = '/static/logo.png';
+    };
+    if (data.thumbnail) {
+        img.src = `/thumbnail/${data.thumbnail}`;
+    } else {
+        img.src = data.image || '/static/logo.png';
+    }
+}
+
+function populateTemplate(type, data, container) {
     let templateId;
     let element;
 
@@ -50,32 +71,36 @@ function populateTemplate(type, data) {
     const downloadButton = clone.querySelector('.download');
 
     if (type === 'track') {
-        clone.querySelector('.track-img').src = data.image || 'https://picsum.photos/300';
+        setImage(clone.querySelector('.track-img'), data);
         clone.querySelector('.name').textContent = data.name;
         clone.querySelector('.artist').textContent = data.artist;
         clone.querySelector('.download').href = data.url;
         clone.querySelector('.download').setAttribute('data-url', data.url);
+        if (data.downloaded) {
+            downloadButton.innerText = 'In Library';
+            downloadButton.classList.replace('btn-primary', 'btn-outline-success');
+        }
     } else if (type === 'album') {
-        clone.querySelector('.album-img').src = data.image || 'https://picsum.photos/300';
+        setImage(clone.querySelector('.album-img'), data);
         clone.querySelector('.name').textContent = data.name;
         clone.querySelector('.artist').textContent = data.artist;
         clone.querySelector('.download').href = data.url;
         clone.querySelector('.download').setAttribute('data-url', data.url);
     } else if (type === 'artist') {
-        clone.querySelector('.artist-img').src = data.image || 'https://picsum.photos/300';
+        setImage(clone.querySelector('.artist-img'), data);
         clone.querySelector('.name').textContent = data.name;
         clone.querySelector('.followers').textContent = `${data.followers} Followers`;
         clone.querySelector('.download').href = data.url;
         clone.querySelector('.download').setAttribute('data-url', data.url);
     } else if (type === 'playlist') {
-        clone.querySelector('.playlist-img').src = data.image || 'https://picsum.photos/300';
+        setImage(clone.querySelector('.playlist-img'), data);
         clone.querySelector('.name').textContent = data.name;
         clone.querySelector('.owner').textContent = data.owner;
         clone.querySelector('.download').href = data.url;
         clone.querySelector('.download').setAttribute('data-url', data.url);
     }
 
-    element = document.getElementById('results-section');
+    element = container || document.getElementById('results-section');
     element.appendChild(clone);
 
     downloadButton.addEventListener('click', function (event) {
@@ -105,7 +130,9 @@ function handleDownloadClick(event) {
         type: card.querySelector('.type')?.textContent.trim().toLowerCase(),
         name: card.querySelector('.name')?.textContent.trim(),
         artist: card.querySelector('.artist')?.textContent.trim() || null,
-        url: trackUrl
+        url: trackUrl,
+        profile: profileSelect.value || null,
+        client_id: clientId
     };
 
     socket.emit('download_item', itemData);
@@ -120,7 +147,60 @@ searchInput.addEventListener('keydown', function (event) {
 
 searchButton.addEventListener('click', initiateSearch);
 
+function renderCategory(category, items) {
+    // Categories arrive in any order but are always shown tracks first
+    const resultsSection = document.getElementById('results-section');
+    const rank = categoryOrder.indexOf(category);
+    const nextNode = Array.from(resultsSection.children).find(child => categoryOrder.indexOf(child.dataset.category) > rank) || null;
+
+    const fragment = document.createDocumentFragment();
+    if (items.length > 0) {
+        items.forEach(item => {
+            populateTemplate(item.type, item, fragment);
+        });
+    } else {
+        const noResultsMessage = document.createElement('p');
+        noResultsMessage.textContent = 'No results found';
+        fragment.appendChild(noResultsMessage);
+    }
+    Array.from(fragment.children).forEach(child => {
+        child.dataset.category = category;
+    });
+    resultsSection.insertBefore(fragment, nextNode);
+}
+
+socket.on('connect', function () {
+    socket.emit('get_profiles');
+});
+
+socket.on('profiles', function (profiles) {
+    // Keep the current choice if the profile still exists after a reload
+    const selected = profileSelect.value;
+    profileSelect.replaceChildren(new Option('Default', ''));
+    profiles.forEach(profile => profileSelect.add(new Option(profile, profile)));
+    profileSelect.value = profiles.includes(selected) ? selected : '';
+    profileGroup.style.display = profiles.length ? 'flex' : 'none';
+});
+
+socket.on('search_category', function (data) {
+    if (data.request_id !== searchRequestId) {
+        return;
+    }
+    const resultsSection = document.getElementById('results-section');
+    if (resultsSection.dataset.requestId !== String(data.request_id)) {
+        resultsSection.dataset.requestId = data.request_id;
+        resultsSection.innerHTML = '';
+    }
+    renderCategory(data.category, data.items);
+    if (data.remaining === 0) {
+        changeUI("ready");
+    }
+});
+
 socket.on('search_results', function (data) {
+    if (data.request_id !== searchRequestId) {
+        return;
+    }
     changeUI("ready");
     const resultsSection = document.getElementById('results-section');
     resultsSection.innerHTML = '';
@@ -1,51 +1,284 @@
-const socket = io();
+// Several web workers cannot share a long-polling session, a websocket stays on the worker it connected to
+const socket = io(document.body.dataset.websocketOnly === "true" ? { transports: ["websocket"] } : {});
 const cancelActive = document.getElementById('cancel-active-button');
 const cancelAll = document.getElementById('cancel-all-button');
+const historyContainer = document.getElementById("history-body");
+const statusFilter = document.getElementById('status-filter');
+const prevPage = document.getElementById('prev-page-button');
+const nextPage = document.getElementById('next-page-button');
+const pageInfo = document.getElementById('page-info');
+const historyRows = new Map();
+const pageSize = 50;
+const retryableStatuses = ["Failed", "Error", "Cancelled", "Interrupted"];
+const moveButtons = [["top", "bi-chevron-double-up", "Move to top"], ["up", "bi-chevron-up", "Move up"], ["down", "bi-chevron-down", "Move down"]];
+const clientId = localStorage.getItem('clientId');
+let currentPage = 1;
+let totalItems = 0;
+let statusVersion = null;
+let snapshotRequested = false;
+let positionsTimer = null;
 
 window.onload = function () {
-    socket.emit("get_status");
+    requestSnapshot();
 };
 
+function requestSnapshot() {
+    if (snapshotRequested) {
+        return;
+    }
+    snapshotRequested = true;
+    socket.emit("get_status", { page: currentPage, page_size: pageSize, status: statusFilter.value || null });
+}
+
+function schedulePositionsRefresh() {
+    // Positions are fetched for this page's waiting rows only, at most once a second
+    if (positionsTimer !== null) {
+        return;
+    }
+    positionsTimer = setTimeout(function () {
+        positionsTimer = null;
+        const ids = [];
+        for (const [id, row] of historyRows) {
+            if (row.querySelector(".status").textContent === "Pending...") {
+                ids.push(id);
+            }
+        }
+        if (ids.length) {
+            socket.emit("get_queue_positions", { ids: ids });
+        }
+    }, 1000);
+}
+
+function changePage(page) {
+    currentPage = page;
+    snapshotRequested = false;
+    requestSnapshot();
+}
+
+function createRow() {
+    const row = document.createElement("tr");
+
+    const nameCell = document.createElement("td");
+    nameCell.className = "name";
+    row.appendChild(nameCell);
+
+    const typeCell = document.createElement("td");
+    typeCell.className = "type";
+    row.appendChild(typeCell);
+
+    const artistCell = document.createElement("td");
+    artistCell.className = "artist";
+    row.appendChild(artistCell);
+
+    const urlCell = document.createElement("td");
+    const urlLink = document.createElement("a");
+    urlLink.className = "url";
+    urlLink.target = "_blank";
+    urlCell.appendChild(urlLink);
+    row.appendChild(urlCell);
+
+    const statusCell = document.createElement("td");
+    const statusText = document.createElement("span");
+    statusText.className = "status";
+    statusCell.appendChild(statusText);
+    const progressText = document.createElement("small");
+    progressText.className = "progress-info d-block text-body-secondary";
+    statusCell.appendChild(progressText);
+    const retryButton = document.createElement("button");
+    retryButton.type = "button";
+    retryButton.className = "retry btn btn-outline-secondary btn-sm mt-1";
+    retryButton.textContent = "Retry";
+    retryButton.addEventListener("click", function () {
+        retryButton.disabled = true;
+        socket.emit("retry_item", { id: Number(row.dataset.id), client_id: clientId });
+    });
+    statusCell.appendChild(retryButton);
+    const moveGroup = document.createElement("div");
+    moveGroup.className = "move btn-group btn-group-sm mt-1";
+    moveButtons.forEach(function ([direction, icon, title]) {
+        const moveButton = document.createElement("button");
+        moveButton.type = "button";
+        moveButton.className = "btn btn-outline-secondary";
+        moveButton.title = title;
+        moveButton.innerHTML = `<i class="${icon}"></i>`;
+        moveButton.addEventListener("click", function () {
+            socket.emit("move_item", { id: Number(row.dataset.id), direction: direction });
+        });
+        moveGroup.appendChild(moveButton);
+    });
+    statusCell.appendChild(moveGroup);
+    row.appendChild(statusCell);
+
+    return row;
+}
+
+function updateRow(row, item) {
+    // Only touch the cells whose text actually changed
+    const fields = { name: item.name, type: item.type, artist: item.artist, url: item.url, status: item.status };
+    for (const field in fields) {
+        const cell = row.querySelector(`.${field}`);
+        const value = fields[field] ?? "";
+        if (cell.textContent !== String(value)) {
+            cell.textContent = value;
+        }
+    }
+    const urlLink = row.querySelector(".url");
+    if (urlLink.getAttribute("href") !== item.url) {
+        urlLink.href = item.url;
+    }
+    row.dataset.id = item.id;
+    const retryButton = row.querySelector(".retry");
+    retryButton.hidden = !retryableStatuses.includes(item.status);
+    retryButton.disabled = false;
+    setQueuePosition(row, item.status, item.queue_position);
+}
+
+function setQueuePosition(row, status, position) {
+    // Only jobs still waiting in the queue can be moved
+    const queued = status === "Pending..." && position !== undefined;
+    row.querySelector(".move").hidden = !queued;
+    if (queued) {
+        row.querySelector(".progress-info").textContent = `Queue position ${position}`;
+    } else if (status !== "Downloading...") {
+        row.querySelector(".progress-info").textContent = "";
+    }
+}
+
+function formatProgress(progress) {
+    let text = progress.total ? `${progress.completed}/${progress.total} tracks` : `${progress.completed} tracks`;
+    if (progress.failed) {
+        text += `, ${progress.failed} failed`;
+    }
+    if (progress.current) {
+        text += ` - ${progress.current}`;
+    }
+    return text;
+}
+
+function upsertItem(item) {
+    // Tracks of an expanded album or playlist are summed up on their parent row
+    if (item.parent_id) {
+        return;
+    }
+    let row = historyRows.get(item.id);
+    if (!row) {
+        // New items only appear on the first page when they match the filter
+        if (currentPage !== 1 || (statusFilter.value && statusFilter.value !== item.status)) {
+            return;
+        }
+        row = createRow();
+        historyRows.set(item.id, row);
+        historyContainer.prepend(row);
+        totalItems += 1;
+
+        if (historyRows.size > pageSize) {
+            const lastRow = historyContainer.lastElementChild;
+            for (const [id, existingRow] of historyRows) {
+                if (existingRow === lastRow) {
+                    historyRows.delete(id);
+                    break;
+                }
+            }
+            lastRow.remove();
+        }
+    }
+    // Patches carry no queue position, a new or finished waiting job shifts the others
+    const wasPending = row.querySelector(".status").textContent === "Pending...";
+    if (wasPending || item.status === "Pending...") {
+        schedulePositionsRefresh();
+    }
+    updateRow(row, item);
+}
+
+function updatePageInfo() {
+    const pageCount = Math.max(1, Math.ceil(totalItems / pageSize));
+    pageInfo.textContent = `Page ${currentPage} of ${pageCount} (${totalItems} items)`;
+    prevPage.disabled = currentPage <= 1;
+    nextPage.disabled = currentPage >= pageCount;
+}
+
+function updateEmptyMessage() {
+    document.getElementById("no-downloads-msg").style.display = historyRows.size === 0 ? "block" : "none";
+    updatePageInfo();
+}
+
 socket.on("update_status", function (data) {
-    const historyContainer = document.getElementById("history-body");
-    historyContainer.innerHTML = "";
-
-    if (data.history.length === 0) {
-        document.getElementById("no-downloads-msg").style.display = "block";
-    } else {
-        document.getElementById("no-downloads-msg").style.display = "none";
-        data.history.forEach(function (item) {
-            const row = document.createElement("tr");
-
-            const nameCell = document.createElement("td");
-            nameCell.textContent = item.name;
-            row.appendChild(nameCell);
-
-            const typeCell = document.createElement("td");
-            typeCell.textContent = item.type;
-            row.appendChild(typeCell);
-
-            const artistCell = document.createElement("td");
-            artistCell.textContent = item.artist;
-            row.appendChild(artistCell);
-
-            const urlCell = document.createElement("td");
-            const urlLink = document.createElement("a");
-            urlLink.href = item.url;
-            urlLink.textContent = item.url;
-            urlLink.target = "_blank";
-            urlCell.appendChild(urlLink);
-            row.appendChild(urlCell);
-
-            const statusCell = document.createElement("td");
-            statusCell.textContent = item.status;
-            row.appendChild(statusCell);
-
-            historyContainer.appendChild(row);
+    snapshotRequested = false;
+    statusVersion = data.version;
+    currentPage = data.page;
+    totalItems = data.total;
+
+    const fragment = document.createDocumentFragment();
+    historyRows.clear();
+    data.history.forEach(function (item) {
+        const row = createRow();
+        updateRow(row, item);
+        historyRows.set(item.id, row);
+        fragment.appendChild(row);
+    });
+    historyContainer.replaceChildren(fragment);
+    updateEmptyMessage();
+});
+
+socket.on("status_patch", function (data) {
+    if (statusVersion === null || data.version <= statusVersion) {
+        return;
+    }
+    if (data.base_version !== statusVersion) {
+        // Missed a patch, resync from a full snapshot
+        requestSnapshot();
+        return;
+    }
+    statusVersion = data.version;
+    data.items.forEach(upsertItem);
+    updateEmptyMessage();
+});
+
+socket.on("progress", function (data) {
+    data.items.forEach(function (progress) {
+        const text = formatProgress(progress);
+        progress.ids.forEach(function (id) {
+            const row = historyRows.get(id);
+            // Progress can arrive just after the final status, which already says it all
+            if (row && row.querySelector(".status").textContent === "Downloading...") {
+                row.querySelector(".progress-info").textContent = text;
+            }
         });
+    });
+});
+
+socket.on("queue_positions", function (data) {
+    const positions = new Map(data.positions);
+    for (const [id, row] of historyRows) {
+        const status = row.querySelector(".status").textContent;
+        if (status === "Pending...") {
+            setQueuePosition(row, status, positions.get(id));
+        }
+    }
+});
+
+socket.on("queue_changed", function () {
+    schedulePositionsRefresh();
+});
+
+socket.on("connect", function () {
+    if (statusVersion !== null) {
+        requestSnapshot();
     }
 });
 
+statusFilter.addEventListener('change', function () {
+    changePage(1);
+});
+
+prevPage.addEventListener('click', function () {
+    changePage(currentPage - 1);
+});
+
+nextPage.addEventListener('click', function () {
+    changePage(currentPage + 1);
+});
+
 cancelActive.addEventListener('click', function () {
     socket.emit("cancel_active");
 });
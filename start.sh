@@ -53,6 +53,18 @@ echo "Setting up directories..."
 chown -R appuser:appgroup /config /data /home/appuser/.spotdl/.spotipy 
 chmod -R 777 /config /home 
 
+# Downloads run in their own process when the web side is split across workers
+if [ "$DOWNLOAD_RUNNER" = "separate" ] || [ "${WEB_WORKERS:-1}" -gt 1 ]; then
+    echo "Starting download runner..."
+    (
+        while true; do
+            su-exec appuser:appgroup python spotspot/download_runner.py
+            echo "Download runner exited, restarting in 5 seconds..."
+            sleep 5
+        done
+    ) &
+fi
+
 # Start the application as appuser
 echo "Starting SpotSpot..."
 exec su-exec appuser:appgroup gunicorn spotspot.spotspot:app -c start_app.py
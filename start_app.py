@@ -1,5 +1,8 @@
+import os
+
 bind = "0.0.0.0:6544"
-workers = 1
+# More than one worker needs DOWNLOAD_RUNNER=separate and SOCKETIO_MESSAGE_QUEUE
+workers = int(os.getenv("WEB_WORKERS", "1"))
 threads = 4
 timeout = 180
 worker_class = "geventwebsocket.gunicorn.workers.GeventWebSocketWorker"